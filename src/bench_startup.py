@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# Measure startup time and RSS for each part of the app. Each measurement runs in a fresh interpreter, so nothing is
+# already imported, and every row is timed the same way: from just before its imports to just after.
+#
+# Consumer rows run the real src/consume-mail.py once over an empty directory, in a scratch directory with a copy of the
+# config, so they follow whatever the script actually imports and sets up. The "before" row first imports what the
+# consumer used to load at startup, when the results layer lived in webReporter (pulling in Flask) and the network
+# libraries were imported eagerly, so the difference is the saving.
+import os, sys, shutil, tempfile, subprocess, statistics, argparse
+
+srcDir = os.path.dirname(os.path.abspath(__file__))
+iniFile = os.path.join(srcDir, '..', 'consume-mail.ini')
+networkMods = 'requests, dns.resolver, smtplib'
+
+# (name, modules to import first, whether to then run the consumer script)
+rows = [
+    ('consumer (before: via webReporter, eager imports)', 'webReporter, ' + networkMods, True),
+    ('consumer (now: results, lazy imports)',             None,                           True),
+    ('consumer (now, after first open/FBL/OOB)',          networkMods,                    True),
+    ('web reporter',                                      'webReporter',                  False),
+    ('chk_ tools',                                        'results',                      False),
+]
+
+probe = '''
+import os, sys, time, resource, runpy
+sys.path.insert(0, {srcDir!r})
+t = time.perf_counter()
+{imports}
+if {runConsumer!r}:
+    os.chdir({workDir!r})
+    sys.argv = ['consume-mail.py', 'inbound']
+    runpy.run_path(os.path.join({srcDir!r}, 'consume-mail.py'), run_name='__main__')
+el = time.perf_counter() - t
+print(el, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+# Median time (s) and max RSS (kB) over runs. A probe that fails raises CalledProcessError, rather than being
+# reported as a fast start
+def measure(mods, runConsumer, workDir, runs):
+    times, rss = [], []
+    code = probe.format(srcDir=srcDir, workDir=workDir, runConsumer=runConsumer, imports='import ' + mods if mods else '')
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=srcDir, universal_newlines=True)
+        t, r = out.split()[-2:]
+        times.append(float(t))
+        rss.append(int(r))
+    return statistics.median(times), statistics.median(rss)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure startup time and peak RSS of the app\'s parts.')
+    parser.add_argument('-n', type=int, default=5, help='runs per measurement, median is reported (default: %(default)s)')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as workDir:
+        shutil.copy(iniFile, workDir)
+        os.mkdir(os.path.join(workDir, 'inbound'))
+        print('{:50} {:>12} {:>12}'.format('part', 'startup (ms)', 'max RSS (MB)'))
+        for name, mods, runConsumer in rows:
+            t, r = measure(mods, runConsumer, workDir, args.n)
+            print('{:50} {:12.1f} {:12.1f}'.format(name, t * 1000, r / 1024))    # ru_maxrss is in kB on Linux
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+#
+# Per-message time budget. Created when a message starts, and passed down to every network call, which takes its
+# timeout from what is left. Once the budget is used up, further calls are skipped by raising BudgetExpired.
+#
+import time
+
+
+class BudgetExpired(Exception):
+    pass
+
+
+class Budget():
+    def __init__(self, seconds):
+        self.deadline = time.time() + seconds if seconds and seconds > 0 else None     # 0 = no budget
+
+    def remaining(self):
+        return float('inf') if self.deadline is None else self.deadline - time.time()
+
+    # Timeout for the next network call: the smaller of the call's own limit (None = no limit) and the budget left
+    def timeout(self, cap=None):
+        r = self.remaining()
+        if r <= 0:
+            raise BudgetExpired('message time budget used up')
+        if r == float('inf'):
+            return cap
+        return r if cap is None else min(cap, r)
+
+noBudget = Budget(0)
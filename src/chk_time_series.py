@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 # simple tool to check output from same functions as web reporting uses
-from webReporter import Results
+from results import Results
 import json
 
 shareRes = Results()
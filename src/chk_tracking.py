@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 # simple tool to check status of tracking domains
-import os, json, redis
+from results import Results
 
 def get_array(r, ts_pfx):
     for k in r.scan_iter(match=ts_pfx+'*'):
@@ -9,8 +9,6 @@ def get_array(r, ts_pfx):
         print('{},{},EX={}'.format(k.decode('utf-8'), v, ttl))
 
 
-redisUrl = os.getenv('REDIS_URL', default='redis://localhost')      # Env var is set by Heroku; will be unset when local
-redis_client = redis.from_url(redisUrl, socket_timeout=5)                 # shorten timeout so doesn't hang forever
-print('Opened redis connection to {}'.format(redis_client))
-get_array(redis_client, 'http')
-
+shareRes = Results()                                                # same connection and key prefix as the consumer uses
+print('Opened redis connection to {}'.format(shareRes.r))
+get_array(shareRes.r, shareRes.rkeyPrefix + 'http')
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#
+# Adaptive concurrency: adjusts the number of worker threads in use for bulk mail, between Min_Threads and Max_Threads less
+# Directed_Reserved_Threads, to track the point beyond which more threads stop giving more throughput. That point moves
+# with the open / click mix and with tracking endpoint and SMTP latency, so a fixed Max_Threads is either too few or too
+# many for much of the week. The directed workers are reserved on top of the limit set here, so every step changes the
+# bulk throughput being measured.
+#
+# AIMD hill-climbing. Every interval during which work was waiting for a worker (so the limit was what held throughput):
+#   - if per-message latency has risen well above its baseline, the far end or this host is overloaded: back off
+#   - else if the last increase gave no real throughput gain, we are past the knee: back off
+#   - otherwise add a thread
+# Multiplicative decrease, additive increase, so the limit saws gently around the knee. When there is no backlog
+# the limit is left alone. Decisions are logged, and exported as gauge_concurrency_* gauges and int_concurrency_*
+# counters.
+#
+import time, threading
+
+
+class ConcurrencyController():
+    def __init__(self, minThreads, maxThreads, interval=10, backoff=0.8, minGain=0.05, latencyTolerance=2.0, logger=None):
+        self.minThreads = minThreads
+        self.maxThreads = maxThreads
+        self.interval = interval                            # seconds between decisions
+        self.backoff = backoff                              # multiplicative decrease factor
+        self.minGain = minGain                              # fractional throughput gain that justifies an increase
+        self.latencyTolerance = latencyTolerance            # latency / baseline ratio taken as overload
+        self.logger = logger
+        self.limit = minThreads
+        self.lock = threading.Lock()
+        self.baseline = None                                # latency baseline, follows lows quickly and highs slowly
+        self.prevLimit, self.prevTput = None, None
+        self.done, self.latencySum = 0, 0.0
+        self.reset()
+
+    # Start a new measurement window, e.g. at the start of a run after an idle spell
+    def reset(self):
+        self.takeCompleted()
+        self.windowStart = time.time()
+        self.samples, self.saturated = 0, 0
+        self.backlogSum = 0
+
+    # Messages completed, and their total time, since last called
+    def takeCompleted(self):
+        with self.lock:
+            r = self.done, self.latencySum
+            self.done, self.latencySum = 0, 0.0
+        return r
+
+    # Worker thread target: run fn, and record how long it took
+    def run(self, fn, *args):
+        t = time.time()
+        try:
+            fn(*args)
+        finally:
+            el = time.time() - t
+            with self.lock:
+                self.done += 1
+                self.latencySum += el
+
+    # Called from the dispatch loop with the number of files waiting. Returns the current limit. The dispatcher only
+    # leaves files waiting when all the workers it may use are busy, so a steady backlog means the limit is binding
+    def update(self, backlog, shareRes):
+        self.samples += 1
+        self.backlogSum += backlog
+        if backlog > 0:
+            self.saturated += 1
+        if time.time() - self.windowStart >= self.interval:
+            self.decide(shareRes)
+        return self.limit
+
+    def decide(self, shareRes):
+        el = time.time() - self.windowStart
+        done, latencySum = self.takeCompleted()
+        tput = done / el
+        lat = latencySum / done if done else 0.0
+        saturated = self.samples and self.saturated / self.samples >= 0.8
+        backlog = self.backlogSum / self.samples if self.samples else 0
+        if done:
+            self.baseline = lat if self.baseline is None else min(lat, 0.95 * self.baseline + 0.05 * lat)
+
+        old = self.limit
+        if not saturated:
+            reason = 'hold, no backlog'
+        elif self.baseline and lat > self.baseline * self.latencyTolerance:
+            self.limit = max(self.minThreads, int(self.limit * self.backoff))
+            reason = 'latency above baseline'
+        elif self.prevLimit is not None and old > self.prevLimit and tput < self.prevTput * (1 + self.minGain):
+            self.limit = max(self.minThreads, int(self.limit * self.backoff))
+            reason = 'no throughput gain'
+        else:
+            self.limit = min(self.maxThreads, self.limit + 1)
+            reason = 'probing'
+        if saturated:
+            self.prevLimit, self.prevTput = old, tput
+
+        if self.logger:
+            self.logger.info('** Concurrency {} -> {}: {}, throughput {:.1f}/s, latency {:.0f}ms (baseline {:.0f}ms), '
+                'backlog {:.0f}'.format(old, self.limit, reason, tput, lat * 1000, (self.baseline or 0) * 1000, backlog))
+        try:
+            pipe = shareRes.r.pipeline(transaction=False)
+            g = shareRes.rkeyPrefix + 'gauge_concurrency_'
+            pipe.set(g + 'limit', self.limit)
+            pipe.set(g + 'throughput_per_min', int(tput * 60))
+            pipe.set(g + 'latency_ms', int(lat * 1000))
+            p = shareRes.rkeyPrefix + 'int_concurrency_'
+            if self.limit > old:
+                pipe.incr(p + 'increases')
+            elif self.limit < old:
+                pipe.incr(p + 'decreases')
+            pipe.execute()
+        except Exception:
+            pass                                            # metrics must not stop the consumer
+        self.windowStart = time.time()
+        self.samples, self.saturated, self.backlogSum = 0, 0, 0
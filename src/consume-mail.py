@@ -7,17 +7,28 @@
 # Pre-requisites:
 #   pip3 install requests, dnspython
 #
-import os, email, time, glob, requests, dns.resolver, smtplib, configparser, random, argparse, csv, re
-import threading, queue
+# requests, dns.resolver and smtplib are imported only on the paths that use them, to keep startup fast and small.
+#
+import os, email, time, glob, random, argparse, csv, re
+import threading, queue, signal, logging, resource
 
 from html.parser import HTMLParser
 # workaround as per https://stackoverflow.com/questions/45124127/unable-to-extract-the-body-of-the-email-file-in-python
 from email import policy
-from webReporter import Results, timeStr
+from results import Results, timeStr
 from urllib.parse import urlparse
 from datetime import datetime
-from bouncerate import nWeeklyCycle
+from model import getBounceProbabilities, getSignalsOpenDays
 from common import readConfig, configFileName, createLogger, baseProgName, xstr
+from sketches import DimensionStats, MessageStats
+from tracking import isSparkPostTrackingEndpoint, touchEndPoint
+from scheduler import EngagementScheduler
+from tracer import Tracer, span
+from budget import Budget, BudgetExpired, noBudget
+from lanes import LaneQueue, LaneStats, laneNames
+from dedup import RotatingBloomFilter, RedisDedup
+from profiler import Profiler
+from concurrency import ConcurrencyController
 
 
 # -----------------------------------------------------------------------------
@@ -137,15 +148,18 @@ def findPreferredMX(a):
 
 # Avoid creating backscatter spam https://en.wikipedia.org/wiki/Backscatter_(email). Check that returnPath points to a known host.
 # If valid, returns the (single, preferred, for simplicity) MX and the associated To: addr for FBLs.
-def mapRP_MXtoSparkPostFbl(returnPath):
+def mapRP_MXtoSparkPostFbl(returnPath, budget=noBudget):
+    import dns.resolver
     rpDomainPart = returnPath.split('@')[1]
     try:
         # Will throw exception if not found
-        mx = findPreferredMX(dns.resolver.query(rpDomainPart, 'MX'))
+        with span('dns', rpDomainPart):
+            mx = findPreferredMX(dns.resolver.query(rpDomainPart, 'MX', lifetime=budget.timeout()))
     except dns.exception.DNSException:
         try:
             # Fall back to using A record - see https://tools.ietf.org/html/rfc5321#section-5
-            answers = dns.resolver.query(rpDomainPart, 'A')
+            with span('dns', rpDomainPart):
+                answers = dns.resolver.query(rpDomainPart, 'A', lifetime=budget.timeout())
             if answers:
                 mx = rpDomainPart
             else:
@@ -185,7 +199,7 @@ def getPeerIP(rx):
 # Generate and deliver an FBL response (to cause a spam_complaint event in SparkPost)
 # Based on https://github.com/SparkPost/gosparkpost/tree/master/cmd/fblgen
 #
-def fblGen(mail, shareRes):
+def fblGen(mail, shareRes, budget=noBudget):
     returnPath = addressPart(mail['Return-Path'])
     if not returnPath:
         shareRes.incrementKey('fbl_missing_return_path')
@@ -195,7 +209,7 @@ def fblGen(mail, shareRes):
         return '!Missing To:'
     else:
         fblFrom = addressPart(mail['to'])
-        mx, fblTo = mapRP_MXtoSparkPostFbl(returnPath)
+        mx, fblTo = mapRP_MXtoSparkPostFbl(returnPath, budget)
         if not mx:
             shareRes.incrementKey('fbl_return_path_not_sparkpost')
             return '!FBL not sent, Return-Path not recognized as SparkPost'
@@ -204,13 +218,16 @@ def fblGen(mail, shareRes):
             origTo = str(mail['to'])
             peerIP = getPeerIP(mail['Received'])
             mailDate = mail['Date']
+            import smtplib
             arfMsg = buildArf(fblFrom, fblTo, mail, mail['X-MSFBL'], returnPath, origFrom, origTo, peerIP, mailDate)
             try:
                 # Deliver an FBL to SparkPost using SMTP direct, so that we can check the response code.
-                with smtplib.SMTP(mx) as smtpObj:
+                with span('smtp', mx), smtplib.SMTP(mx, timeout=budget.timeout()) as smtpObj:
                     smtpObj.sendmail(fblFrom, fblTo, arfMsg)        # if no exception, the mail is sent (250OK)
                     shareRes.incrementKey('fbl_sent')
                     return 'FBL sent,to ' + fblTo + ' via ' + mx
+            except BudgetExpired:
+                raise
             except Exception as err:
                 shareRes.incrementKey('fbl_smtp_error')
                 return '!FBL endpoint returned error: ' + str(err)
@@ -218,7 +235,7 @@ def fblGen(mail, shareRes):
 
 # Generate and deliver an OOB response (to cause a out_of_band event in SparkPost)
 # Based on https://github.com/SparkPost/gosparkpost/tree/master/cmd/oobgen
-def oobGen(mail, shareRes):
+def oobGen(mail, shareRes, budget=noBudget):
     returnPath = addressPart(mail)
     if not returnPath:
         shareRes.incrementKey('oob_missing_return_path')
@@ -227,7 +244,7 @@ def oobGen(mail, shareRes):
         shareRes.incrementKey('oob_missing_to')
         return '!Missing To:'
     else:
-        mx, _ = mapRP_MXtoSparkPostFbl(returnPath)
+        mx, _ = mapRP_MXtoSparkPostFbl(returnPath, budget)
         if not mx:
             shareRes.incrementKey('oob_return_path_not_sparkpost')
             return '!OOB not sent, Return-Path ' + returnPath + ' does not have a valid MX'
@@ -237,13 +254,16 @@ def oobGen(mail, shareRes):
             oobFrom = addressPart(mail['To'])
             peerIP = getPeerIP(mail['Received'])
             mailDate = mail['Date']
+            import smtplib
             oobMsg = buildOob(oobFrom, oobTo, mail, peerIP, mailDate)
             try:
                 # Deliver an OOB to SparkPost using SMTP direct, so that we can check the response code.
-                with smtplib.SMTP(mx) as smtpObj:
+                with span('smtp', mx), smtplib.SMTP(mx, timeout=budget.timeout()) as smtpObj:
                     smtpObj.sendmail(oobFrom, oobTo, oobMsg)            # if no exception, the mail is sent (250OK)
                     shareRes.incrementKey('oob_sent')
                     return 'OOB sent,from {} to {} via {}'.format(oobFrom, oobTo, mx)
+            except BudgetExpired:
+                raise
             except Exception as err:
                 shareRes.incrementKey('oob_smtp_error')
                 return '!OOB endpoint returned error: ' + str(err)
@@ -253,39 +273,9 @@ def oobGen(mail, shareRes):
 # Open and Click handling
 # -----------------------------------------------------------------------------
 
-# Heuristic for whether this is really SparkPost: identifies itself in Server header
-# if domain in allowlist, then skip the checks
-def isSparkPostTrackingEndpoint(s, url, shareRes, openClickTimeout, trackingDomainsAllowlist):
-    err = None
-    scheme, netloc, _, _, _, _ = urlparse(url)
-    if netloc in trackingDomainsAllowlist:
-        return True, err
-    baseurl = scheme + '://' + netloc
-    # optimisation - check if we already know this is SparkPost or not
-    known = shareRes.getKey(baseurl)
-    if known:
-        known_bool = (known == b'1')
-        if not known_bool:
-            err = '!Tracking domain ' + baseurl + ' blocked'
-        return known_bool, err                                # response is Bytestr, compare back to a Boolean
-    else:
-        # Ping the path prefix for clicks
-        r = s.get(baseurl + '/f/a', allow_redirects=False, timeout=openClickTimeout)
-        isSparky = r.headers.get('Server') == 'msys-http'
-        if not isSparky:
-            err = url + ',status_code ' + str(r.status_code)
-        # NOTE redis-py now needs data passed in bytestr
-        isB = str(int(isSparky)).encode('utf-8')
-        _ = shareRes.setKey(baseurl, isB, ex=3600)         # mark this as known, but with an expiry time
-        return isSparky, err
-
-# Improved "GET" - doesn't follow the redirect, and opens as stream (so doesn't actually fetch a lot of stuff)
-def touchEndPoint(s, url, openClickTimeout, userAgent):
-    _ = s.get(url, allow_redirects=False, timeout=openClickTimeout, stream=True, headers={'User-Agent': userAgent})
-
 # Parse html email body, looking for open-pixel and links.  Follow these to do open & click tracking
 class MyHTMLOpenParser(HTMLParser):
-    def __init__(self, s, shareRes, openClickTimeout, userAgent, trackingDomainsAllowlist):
+    def __init__(self, s, shareRes, openClickTimeout, userAgent, trackingDomainsAllowlist, budget):
         HTMLParser.__init__(self)
         self.requestSession = s                             # Use persistent 'requests' session for speed
         self.shareRes = shareRes                            # shared results handle
@@ -293,23 +283,26 @@ class MyHTMLOpenParser(HTMLParser):
         self.openClickTimeout = openClickTimeout
         self.userAgent = userAgent
         self.trackingDomainsAllowlist = trackingDomainsAllowlist
+        self.budget = budget
 
     def handle_starttag(self, tag, attrs):
         if tag == 'img':
             for attrName, attrValue in attrs:
                 if attrName == 'src':
                     # attrValue = url
-                    isSP, self.err = isSparkPostTrackingEndpoint(self.requestSession, attrValue, self.shareRes, self.openClickTimeout, self.trackingDomainsAllowlist)
+                    isSP, self.err = isSparkPostTrackingEndpoint(self.requestSession, attrValue, self.shareRes, self.openClickTimeout, self.trackingDomainsAllowlist, self.budget)
                     if isSP:
-                        touchEndPoint(self.requestSession, attrValue, self.openClickTimeout, self.userAgent)
+                        touchEndPoint(self.requestSession, attrValue, self.openClickTimeout, self.userAgent, self.budget)
+                        self.shareRes.recordDimension('tracking_host', urlparse(attrValue).netloc, 'open')
                     else:
                         self.shareRes.incrementKey('open_url_not_sparkpost')
+                        self.shareRes.recordDimension('tracking_host', urlparse(attrValue).netloc, 'open_url_not_sparkpost')
 
     def err(self):
         return self.err
 
 class MyHTMLClickParser(HTMLParser):
-    def __init__(self, s, shareRes, openClickTimeout, userAgent, trackingDomainsAllowlist):
+    def __init__(self, s, shareRes, openClickTimeout, userAgent, trackingDomainsAllowlist, budget):
         HTMLParser.__init__(self)
         self.requestSession = s                             # Use persistent 'requests' session for speed
         self.shareRes = shareRes                            # shared results handle
@@ -317,29 +310,32 @@ class MyHTMLClickParser(HTMLParser):
         self.openClickTimeout = openClickTimeout
         self.userAgent = userAgent
         self.trackingDomainsAllowlist = trackingDomainsAllowlist
+        self.budget = budget
 
     def handle_starttag(self, tag, attrs):
         if tag == 'a':
             for attrName, attrValue in attrs:
                 if attrName == 'href':
                     # attrValue = url
-                    isSP, self.err = isSparkPostTrackingEndpoint(self.requestSession, attrValue, self.shareRes, self.openClickTimeout, self.trackingDomainsAllowlist)
+                    isSP, self.err = isSparkPostTrackingEndpoint(self.requestSession, attrValue, self.shareRes, self.openClickTimeout, self.trackingDomainsAllowlist, self.budget)
                     if isSP:
-                        touchEndPoint(self.requestSession, attrValue, self.openClickTimeout, self.userAgent)
+                        touchEndPoint(self.requestSession, attrValue, self.openClickTimeout, self.userAgent, self.budget)
+                        self.shareRes.recordDimension('tracking_host', urlparse(attrValue).netloc, 'click')
                     else:
                         self.shareRes.incrementKey('click_url_not_sparkpost')
+                        self.shareRes.recordDimension('tracking_host', urlparse(attrValue).netloc, 'click_url_not_sparkpost')
 
     def err(self):
         return self.err
 
 # open / open again / click / click again logic, as per conditional probabilities
 # takes a persistent requests session object
-def openClickMail(mail, probs, shareRes, s, openClickTimeout, userAgent, trackingDomainsAllowlist):
+def openClickMail(mail, probs, shareRes, s, openClickTimeout, userAgent, trackingDomainsAllowlist, budget=noBudget):
     ll = ''
     bd = mail.get_body(('html',))
     if bd:  # if no body to parse, ignore
         body = bd.get_content()                             # this handles quoted-printable type for us
-        htmlOpenParser = MyHTMLOpenParser(s, shareRes, openClickTimeout, userAgent, trackingDomainsAllowlist)
+        htmlOpenParser = MyHTMLOpenParser(s, shareRes, openClickTimeout, userAgent, trackingDomainsAllowlist, budget)
         shareRes.incrementKey('open')
         htmlOpenParser.feed(body)
         e = htmlOpenParser.err
@@ -349,7 +345,7 @@ def openClickMail(mail, probs, shareRes, s, openClickTimeout, userAgent, trackin
             ll += '_OpenAgain' if e == None else e
             shareRes.incrementKey('open_again')
         if random.random() <= probs['Click_Given_Open']:
-            htmlClickParser = MyHTMLClickParser(s, shareRes, openClickTimeout, userAgent, trackingDomainsAllowlist)
+            htmlClickParser = MyHTMLClickParser(s, shareRes, openClickTimeout, userAgent, trackingDomainsAllowlist, budget)
             htmlClickParser.feed(body)
             ll += '_Click' if e == None else e
             shareRes.incrementKey('click')
@@ -359,6 +355,14 @@ def openClickMail(mail, probs, shareRes, s, openClickTimeout, userAgent, trackin
                 shareRes.incrementKey('click_again')
     return ll
 
+# Opens and clicks for statistical mail are either done now, or if the scheduler is enabled, deferred to be fired later by
+# scheduler.py. Directed openclick mail doesn't come here; it is always done now
+def engage(mail, probs, shareRes, s, openClickTimeout, userAgent, trackingDomainsAllowlist, scheduler, budget):
+    if scheduler:
+        return scheduler.openClick(mail, probs, shareRes, userAgent)
+    else:
+        return openClickMail(mail, probs, shareRes, s, openClickTimeout, userAgent, trackingDomainsAllowlist, budget)
+
 
 def addressSplit(e):
     """
@@ -385,6 +389,26 @@ def addressPart(e):
     return localPart + '@' + domainPart
 
 
+def messageDims(mail):
+    """
+    Dimensions that per-message counters are also attributed to, for the bounded-memory breakdown in sketches.py
+    :param mail: email.message
+    :return: list of (dimension, key) pairs
+    """
+    dims = []
+    for h in ['From', 'Return-Path']:
+        try:
+            _, _, domainPart = addressSplit(mail[h])
+            dims.append(('sending_domain', domainPart))
+            break
+        except ValueError:
+            pass                                # header missing or malformed, try the next one
+    to = xstr(mail['To'])
+    if '@' in to:
+        dims.append(('subdomain', to.split('@')[1].split('.')[0]))
+    return dims
+
+
 # -----------------------------------------------------------------------------
 # Process a single mail file according to the probabilistic model & special subdomains
 # If special subdomains used, these override the model, providing SPF check has passed.
@@ -393,11 +417,15 @@ def addressPart(e):
 # Now opens, parses and deletes the file here inside the sub-process
 # -----------------------------------------------------------------------------
 
-def processMail(fname, probs, shareRes, resQ, session, openClickTimeout, userAgents, signalsTrafficPrefix, signalsOpenDays, doneMsgFileDest, trackingDomainsAllowlist):
+def processMail(fname, probs, shareRes, resQ, session, openClickTimeout, userAgents, signalsTrafficPrefix, signalsOpenDays, doneMsgFileDest, trackingDomainsAllowlist, dimStats, scheduler, tracer, messageBudget, dedup):
     try:
         logline=''
+        budget = Budget(messageBudget)                              # every network call for this message takes its timeout from this
+        if tracer:
+            tracer.begin(fname)
         with open(fname) as fIn:
-            mail = email.message_from_file(fIn, policy=policy.default)
+            with span('parse'):
+                mail = email.message_from_file(fIn, policy=policy.default)
             xhdr = mail['X-Bouncy-Sink']
             if doneMsgFileDest and xhdr and 'store-done' in xhdr.lower():
                 if not os.path.isdir(doneMsgFileDest):
@@ -412,6 +440,13 @@ def processMail(fname, probs, shareRes, resQ, session, openClickTimeout, userAge
             shareRes.incrementKey('total_messages')
             ts_min_resolution = int(time.time()//60)*60
             shareRes.incrementTimeSeries(str(ts_min_resolution))
+            # Skip messages already acted on (e.g. redelivered by PMTA), before doing any network work
+            if dedup and dedup.seen(mail, shareRes):
+                logline += ',!Duplicate skipped'
+                shareRes.incrementKey('duplicate')
+                return
+            # from here on, counters are also attributed to this message's sending domain etc.
+            shareRes = MessageStats(shareRes, dimStats, messageDims(mail), xstr(mail['To']))
             # Test that message was checked by PMTA and has valid DKIM signature
             auth = mail['Authentication-Results']
             if auth != None and 'dkim=pass' in auth:
@@ -419,31 +454,32 @@ def processMail(fname, probs, shareRes, resQ, session, openClickTimeout, userAge
                 subd = mail['to'].split('@')[1].split('.')[0]
 
                 # SparkPost Signals engagement-recency adjustments
-                doIt = True
-                _, localpart, _ = addressSplit(mail['To'])
-                alphaPrefix = localpart.split('+')[0]
-                finalChar = localpart[-1]                           # final char should be a digit 0-9
-                if alphaPrefix == signalsTrafficPrefix and str.isdigit(finalChar):
-                    currentDay = datetime.now().day                 # 1 - 31
-                    finalDigit = int(finalChar)
-                    doIt = currentDay in signalsOpenDays[finalDigit]
-                    logline += ',currentDay={},finalDigit={}'.format(currentDay, finalDigit)
+                with span('decide', subd):
+                    doIt = True
+                    _, localpart, _ = addressSplit(mail['To'])
+                    alphaPrefix = localpart.split('+')[0]
+                    finalChar = localpart[-1]                       # final char should be a digit 0-9
+                    if alphaPrefix == signalsTrafficPrefix and str.isdigit(finalChar):
+                        currentDay = datetime.now().day             # 1 - 31
+                        finalDigit = int(finalChar)
+                        doIt = currentDay in signalsOpenDays[finalDigit]
+                        logline += ',currentDay={},finalDigit={}'.format(currentDay, finalDigit)
 
                 if subd == 'oob':
                     if 'spf=pass' in auth:
-                        logline += ',' + oobGen(mail, shareRes)
+                        logline += ',' + oobGen(mail, shareRes, budget)
                     else:
                         logline += ',!Special ' + subd + ' failed SPF check'
                         shareRes.incrementKey('fail_spf')
                 elif subd == 'fbl':
                     if 'spf=pass' in auth:
-                        logline += ',' + fblGen(mail, shareRes)
+                        logline += ',' + fblGen(mail, shareRes, budget)
                     else:
                         logline += ',!Special ' + subd + ' failed SPF check'
                         shareRes.incrementKey('fail_spf')
                 elif subd == 'openclick':
-                    # doesn't need SPF pass
-                    logline += ',' + openClickMail(mail, probs, shareRes, session, openClickTimeout, random.choice(userAgents), trackingDomainsAllowlist)
+                    # doesn't need SPF pass. Always done now, not scheduled, as a customer test is waiting for the event
+                    logline += ',' + openClickMail(mail, probs, shareRes, session, openClickTimeout, random.choice(userAgents), trackingDomainsAllowlist, budget)
                 elif subd == 'accept':
                     logline += ',Accept'
                     shareRes.incrementKey('accept')
@@ -451,11 +487,11 @@ def processMail(fname, probs, shareRes, resQ, session, openClickTimeout, userAge
                     # Apply probabilistic model to all other domains
                     if random.random() <= probs['OOB']:
                         # Mail that out-of-band bounces would not not make it to the inbox, so would not get opened, clicked or FBLd
-                        logline += ',' + oobGen(mail, shareRes)
+                        logline += ',' + oobGen(mail, shareRes, budget)
                     elif random.random() <= probs['FBL']:
-                        logline += ',' + fblGen(mail, shareRes)
+                        logline += ',' + fblGen(mail, shareRes, budget)
                     elif random.random() <= probs['Open'] and doIt:
-                        logline += ',' + openClickMail(mail, probs, shareRes, session, openClickTimeout, random.choice(userAgents), trackingDomainsAllowlist)
+                        logline += ',' + engage(mail, probs, shareRes, session, openClickTimeout, random.choice(userAgents), trackingDomainsAllowlist, scheduler, budget)
                     else:
                         logline += ',Accept'
                         shareRes.incrementKey('accept')
@@ -463,10 +499,16 @@ def processMail(fname, probs, shareRes, resQ, session, openClickTimeout, userAge
                 logline += ',!DKIM fail:' + xstr(auth)
                 shareRes.incrementKey('fail_dkim')
 
+    except BudgetExpired as err:
+        logline += ',!Skipped remaining actions: ' + str(err)
+        shareRes.incrementKey('budget_expired')
+
     except Exception as err:
         logline += ',!Exception: '+ str(err)
 
     finally:
+        if tracer:
+            tracer.end(shareRes)
         resQ.put(logline)
 
 
@@ -492,21 +534,24 @@ def stopConsumeFiles(logger, shareRes, startTime, countDone):
     endTime = time.time()
     runTime = endTime - startTime
     runRate = (0 if runTime == 0 else countDone / runTime)          # Ensure no divide by zero
-    logger.info('** Process finishing: run time(s)={:.3f},done {},done rate={:.3f}/s'.format(runTime, countDone, runRate))
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss                   # kB on Linux
+    logger.info('** Process finishing: run time(s)={:.3f},done {},done rate={:.3f}/s,peak RSS(MB)={:.1f}'.format(runTime, countDone, runRate, peakRss / 1024))
+    shareRes.setKey_gauge('peak_rss_kb', peakRss)
     history = 10 * 24 * 60 * 60                                     # keep this much time-series history (seconds)
     shareRes.delTimeSeriesOlderThan(int(startTime) - history)
 
 
 # return arrays of resources per thread
 def initThreads(maxThreads):
+    import requests
     th = [None] * maxThreads
     thSession = [None] * maxThreads
     for i in range(maxThreads):
         thSession[i] = requests.session()
     return th, thSession
 
-# search for a free slot, with memory (so acts as round-robin)
-def findFreeThreadSlot(th, thIdx):
+# search for a free slot, with memory (so acts as round-robin). The watchdog, if given, is run each time all slots are busy
+def findFreeThreadSlot(th, thIdx, watchdog=None):
     t = (thIdx+1) % len(th)
     while True:
         if th[t] == None:                       # empty slot
@@ -517,130 +562,173 @@ def findFreeThreadSlot(th, thIdx):
         else:                                   # keep searching
             t = (t+1) % len(th)
             if t == thIdx:
-                # already polled each slot once this call - so wait a while
+                # already polled each slot once this call - so check for hung threads, and wait a while
+                if watchdog:
+                    watchdog()
                 time.sleep(0.1)
 
+# Threads still running well past the per-message budget are hung (e.g. in a call that ignores its timeout). Log what
+# they're doing, and give up their slots, with a fresh requests session, so the pool keeps its concurrency. Python
+# can't kill a thread; it is a daemon, so it won't hold up exit. If it finishes while the process is still running, its
+# result is logged from the process-wide results queue
+def abandonHungThreads(logger, shareRes, th, thStart, thSession, hungAfter, tracer=None):
+    import requests
+    now = time.time()
+    for t, tj in enumerate(th):
+        if tj and tj.is_alive() and now - thStart[t] > hungAfter:
+            logger.error('Thread {} hung, abandoned after {:.1f}s{}'.format(tj, now - thStart[t], ',' + tracer.describe(tj) if tracer else ''))
+            shareRes.incrementKey('worker_hung')
+            th[t] = None
+            thSession[t] = requests.session()
+
 # Wait for threads to complete, marking them as None when done. Get logging results text back from queue, as this is
-# thread-safe and process-safe
-def gatherThreads(logger, th, gatherTimeout):
+# thread-safe and process-safe. The timeout applies to the whole gather, so a drain on shutdown has a known deadline
+def gatherThreads(logger, th, gatherTimeout, tracer=None):
+    deadline = time.time() + gatherTimeout
     for i, tj in enumerate(th):
         if tj:
-            tj.join(timeout=gatherTimeout)  # for safety in case a thread hangs, set a timeout
+            tj.join(timeout=max(0, deadline - time.time()))  # for safety in case a thread hangs, set a timeout
             if tj.is_alive():
-                logger.error('Thread {} timed out'.format(tj))
+                logger.error('Thread {} timed out{}'.format(tj, ',' + tracer.describe(tj) if tracer else ''))
             th[i] = None
 
-# consume a list of files, delegating to worker threads / processes
-def consumeFiles(logger, fnameList, cfg):
+# Derive the per-run settings from config. Returns None if the config is not usable
+def getRunSettings(cfg, logger):
+    signalsTrafficPrefix, signalsOpenDays, activeDigitDensity = getSignalsOpenDays(cfg)
+    probs = getBounceProbabilities(cfg, activeDigitDensity, logger)
+    logger.info(probs)
+    if not probs:
+        return None
+    return {
+        'probs': probs,
+        'openClickTimeout': cfg.getint('Open_Click_Timeout', 30),
+        'gatherTimeout': cfg.getint('Gather_Timeout', 120),
+        'drainTimeout': cfg.getint('Drain_Timeout', 70),
+        'userAgents': getUserAgents(cfg, logger),
+        'signalsTrafficPrefix': signalsTrafficPrefix,
+        'signalsOpenDays': signalsOpenDays,
+        'doneMsgFileDest': cfg.get('Done_Msg_File_Dest'),
+        'trackingDomainsAllowlist': cfg.get('Tracking_Domains_Allowlist').replace(' ','').split(','),
+        'scheduler': EngagementScheduler(cfg) if cfg.getboolean('Engagement_Scheduler', False) else None,
+        'tracer': getTracer(cfg),
+        'messageBudget': cfg.getfloat('Message_Budget', 60),
+        'watchdogGrace': cfg.getfloat('Watchdog_Grace', 5),
+        'directedReserved': cfg.getint('Directed_Reserved_Threads', 4),
+        'laneRescan': cfg.getfloat('Lane_Rescan_Interval', 1),
+        'largeBytes': cfg.getint('Large_Message_KB', 1024) * 1024,
+        'largeThreads': cfg.getint('Large_Message_Threads', 2),
+        'memoryBudget': cfg.getint('Memory_Budget_MB', 256) * 1024 * 1024,
+    }
+
+# consume a list of files, delegating to worker threads / processes. Directed-subdomain mail goes first, and rescan (if
+# given) is called every Lane_Rescan_Interval seconds to pick up directed mail arriving during the run. Returns the
+# config, which may have been reloaded
+def consumeFiles(logger, fnameList, cfg, rescan=None, dedup=None, concurrency=None):
     try:
         shareRes, startTime, maxThreads = startConsumeFiles(logger, cfg, len(fnameList))
         countDone = 0
-        signalsTrafficPrefix = cfg.get('Signals_Traffic_Prefix', '')
-        if signalsTrafficPrefix:
-            maxDayCount = 0
-            activeDigitDays = 0
-            signalsOpenDays= []
-            for i in range(0, 10):
-                daystr = cfg.get('Digit'+str(i)+'_Days', 0)
-                dayset = {int(j) for j in daystr.split(',') }
-                signalsOpenDays.append(dayset)            # list of sets
-                maxDayCount = max(maxDayCount, len(dayset))
-                activeDigitDays += len(dayset)
-            activeDigitDensity = activeDigitDays/(10*maxDayCount)
-        else:
-            activeDigitDensity = 1.0
-        probs = getBounceProbabilities(cfg, activeDigitDensity, logger)
-        logger.info(probs)
-        openClickTimeout = cfg.getint('Open_Click_Timeout', 30)
-        gatherTimeout = cfg.getint('Gather_Timeout', 120)
-        userAgents = getUserAgents(cfg, logger)
-        doneMsgFileDest = cfg.get('Done_Msg_File_Dest')
-        trackingDomainsAllowlist = cfg.get('Tracking_Domains_Allowlist').replace(' ','').split(',')
-        if probs:
+        rs = getRunSettings(cfg, logger)
+        dimStats = getDimensionStats(cfg)
+        if rs:
             th, thSession = initThreads(maxThreads)
-            resultsQ = queue.Queue()
+            thStart = [0.0] * maxThreads                    # when each slot's thread was started, for the watchdog
+            thLane = [None] * maxThreads
+            thBytes = [0] * maxThreads                      # size of each slot's message, for the memory budget
             thIdx = 0                                       # round-robin slot
-            for fname in fnameList:
+            lq = LaneQueue(rs['largeBytes'])
+            lq.add(fnameList)
+            laneStats = LaneStats()
+            lastScan = time.time()
+            limit = maxThreads                              # worker threads in use, set by the adaptive controller if enabled
+            if concurrency:
+                concurrency.reset()
+            while len(lq):
+                if stopRequested.is_set():
+                    logger.info('** Stop requested: taking no more mail files, draining {} thread(s)'.format(sum(1 for t in th if t and t.is_alive())))
+                    break
+                if reloadRequested.is_set():
+                    # swap in new settings for threads started from now on; threads already running keep the old ones
+                    cfg, rs = reloadConfig(cfg, rs, logger)
+                if rescan and time.time() - lastScan >= rs['laneRescan']:
+                    lq.add(rescan(), lanes=('directed',))   # bulk mail arriving now waits for the next run
+                    lastScan = time.time()
+                # check for hung threads every time round, as reserved and adaptive limits can leave free slots that no
+                # lane may use; then get a free process space
+                watchdog = None
+                if rs['messageBudget'] > 0:
+                    watchdog = lambda: abandonHungThreads(logger, shareRes, th, thStart, thSession, rs['messageBudget'] + rs['watchdogGrace'], rs['tracer'])
+                    watchdog()
+                thIdx = findFreeThreadSlot(th, thIdx, watchdog)
+                if concurrency:
+                    # the controller sets the bulk workers, on top of those reserved for directed mail, so each step it
+                    # takes changes the bulk throughput it is measuring
+                    limit = min(maxThreads, concurrency.update(len(lq), shareRes) + rs['directedReserved'])
+                laneBusy = {l: 0 for l in laneNames}
+                inFlight = 0
+                for t, l, b in zip(th, thLane, thBytes):
+                    if t and t.is_alive():
+                        laneBusy[l] += 1
+                        inFlight += b
+                # bulk and large mail may not use the workers reserved for directed mail; large mail has its own lower limit
+                allowed = set()
+                if sum(laneBusy.values()) < limit:
+                    allowed.add('directed')
+                    if laneBusy['bulk'] + laneBusy['large'] < max(1, limit - rs['directedReserved']):
+                        allowed.add('bulk')
+                        if laneBusy['large'] < rs['largeThreads']:
+                            allowed.add('large')
+                # keep the total size of messages in flight within budget, but always allow one, however big
+                fits = lambda size: not rs['memoryBudget'] or inFlight == 0 or inFlight + size <= rs['memoryBudget']
+                nxt = lq.pop(allowed, fits)
+                if not nxt:
+                    time.sleep(0.05)
+                    emitLogs(resultsQ)
+                    continue
+                fname, lane, arrived, size = nxt
                 if os.path.isfile(fname):
-                    # check and get a free process space
-                    thIdx = findFreeThreadSlot(th, thIdx)
-                    th[thIdx] = threading.Thread(target=processMail, args=(fname, probs, shareRes, resultsQ, thSession[thIdx], openClickTimeout, userAgents, signalsTrafficPrefix, signalsOpenDays, doneMsgFileDest, trackingDomainsAllowlist))
+                    work = (concurrency.run, processMail) if concurrency else (processMail,)
+                    th[thIdx] = threading.Thread(target=laneStats.run, name=fname, daemon=True, args=(lane, arrived, *work, fname, rs['probs'], shareRes,
+                        resultsQ, thSession[thIdx], rs['openClickTimeout'], rs['userAgents'], rs['signalsTrafficPrefix'], rs['signalsOpenDays'],
+                        rs['doneMsgFileDest'], rs['trackingDomainsAllowlist'], dimStats, rs['scheduler'], rs['tracer'], rs['messageBudget'], dedup))
+                    thStart[thIdx] = time.time()
+                    thLane[thIdx] = lane
+                    thBytes[thIdx] = size
                     th[thIdx].start()                      # launch concurrent process
                     countDone += 1
+                    laneStats.dispatched(lane, arrived, lq.depth(lane))
+                    laneStats.memory(inFlight + size)
+                    laneStats.flush(shareRes)
                     emitLogs(resultsQ)
             # check any remaining threads to gather back in
-            gatherThreads(logger, th, gatherTimeout)
+            # at the end of a normal run, give every thread still inside its budget the chance to finish
+            gatherTimeout = rs['gatherTimeout']
+            if rs['messageBudget'] > 0:
+                gatherTimeout = max(gatherTimeout, rs['messageBudget'] + rs['watchdogGrace'])
+            gatherThreads(logger, th, rs['drainTimeout'] if stopRequested.is_set() else gatherTimeout, rs['tracer'])
             emitLogs(resultsQ)
+            laneStats.setDepths(lq)
+            laneStats.flush(shareRes, force=True)
+            if dimStats:
+                dimStats.flush(shareRes)
     except Exception as e:                                  # catch any exceptions, keep going
         print(e)
         logger.error(str(e))
     stopConsumeFiles(logger, shareRes, startTime, countDone)
+    return cfg
+
 
+# Result text from worker threads, for the logfile. One queue for the life of the process, so a thread abandoned as hung
+# in one run, that finishes later, is still logged by a later run or while waiting for new files
+resultsQ = queue.Queue()
 
 def emitLogs(resQ):
     while not resQ.empty():
         logger.info(resQ.get())  # write results to the logfile
 
 # -----------------------------------------------------------------------------
-# Set up probabilistic model for incoming mail from config
+# Set up from config. The probabilistic model itself is in model.py
 # -----------------------------------------------------------------------------
 
-# Set conditional probability in mutable dict P for event a given event b. https://en.wikipedia.org/wiki/Conditional_probability
-def checkSetCondProb(P, a, b, logger):
-    aGivenbName = a + '_Given_' + b
-    PaGivenb = P[a] / P[b]
-    if PaGivenb < 0 or PaGivenb > 1:
-        logger.error('Config file problem: {} and {} implies {} = {}, out of range'.format(a, b, aGivenbName, PaGivenb))
-        return None
-    else:
-        P[aGivenbName] = PaGivenb
-        return True
-
-# For safety, clip values to lie in range 0.0 <= n <= 1.0
-def probClip(n):
-    return max(0.0, min(1.0, n))
-
-# Take the overall percentages and adjust them according to how much traffic we expect to receive. This app would not see
-# the 'upstream handled' traffic percentage as PMTA blackholes / in-band-bounces this automatically via PMTA config, not in this application
-# Express all values as probabilities 0 <= p <= 1.0
-#
-# For Signals, scale the open factor to allow for the filtering by active digit density
-def getBounceProbabilities(cfg, activeDigitDensity, logger):
-    try:
-        thisAppTraffic  = 1 - cfg.getfloat('Upstream_Handled') / 100
-        P = {
-            'OOB'       : cfg.getfloat('OOB_percent') / 100 / thisAppTraffic,
-            'FBL'       : cfg.getfloat('FBL_percent') / 100 / thisAppTraffic,
-            'Open'      : cfg.getfloat('Open_percent') / 100 / thisAppTraffic,
-            'OpenAgain' : cfg.getfloat('Open_Again_percent') / 100 / thisAppTraffic,
-            'Click'     : cfg.getfloat('Click_percent') / 100 / thisAppTraffic,
-            'ClickAgain': cfg.getfloat('Click_Again_percent') / 100 / thisAppTraffic
-        }
-        # Adjust open rates according to Signals periodic traffic profile, if present
-        weeklyCycleOpenList = cfg.get('Weekly_Cycle_Open_Rate', '1.0').split(',')
-        weeklyCycleOpenRate = [float(i) for i in weeklyCycleOpenList]
-        todayOpenFactor, _ = nWeeklyCycle(weeklyCycleOpenRate, datetime.utcnow())
-        todayOpenFactor = probClip(todayOpenFactor/activeDigitDensity)
-        P['Open'] = probClip(P['Open'] * todayOpenFactor)
-        P['OpenAgain'] = probClip(P['OpenAgain'] * todayOpenFactor)
-        P['Click'] = probClip(P['Click'] * todayOpenFactor)
-        P['ClickAgain'] = probClip(P['ClickAgain'] * todayOpenFactor)
-
-        # calculate conditional open & click probabilities, given a realistic state sequence would be
-        # Open?
-        #  - Maybe OpenAgain?
-        #  - Maybe Click?
-        #     - Maybe ClickAgain?
-        if checkSetCondProb(P, 'OpenAgain', 'Open', logger) \
-                and checkSetCondProb(P, 'Click', 'Open', logger) \
-                and checkSetCondProb(P, 'ClickAgain', 'Click', logger):
-            return P
-        else:
-            return None
-    except (ValueError, configparser.Error) as e:
-        logger.error('Config file problem: '+str(e))
-        return None
-
 # Get a list of realistic User Agent strings from the specified file in config
 def getUserAgents(cfg, logger):
     uaFileName = cfg.get('User_Agents_File')
@@ -655,6 +743,87 @@ def getUserAgents(cfg, logger):
         logger.error('Unable to open User_Agents_File '+uaFileName)
         return None
 
+# Set up the per-dimension breakdown from config. Sketch sizes fix the Redis memory used, regardless of traffic mix
+def getDimensionStats(cfg):
+    width = cfg.getint('Dimension_Stats_Width', 1024)
+    if width <= 0:
+        return None
+    return DimensionStats(width=width, depth=cfg.getint('Dimension_Stats_Depth', 4), topK=cfg.getint('Dimension_Stats_Top_K', 100),
+        batchSize=cfg.getint('Dimension_Stats_Batch', 500))
+
+# Per-message timeline tracing, for a sampled fraction of messages plus any slower than the threshold
+def getTracer(cfg):
+    sampleRate = cfg.getfloat('Trace_Sample_Rate', 0.001)
+    slowThreshold = cfg.getfloat('Trace_Slow_Threshold', 10)
+    if sampleRate <= 0 and slowThreshold <= 0:
+        return None
+    return Tracer(sampleRate, slowThreshold if slowThreshold > 0 else float('inf'), cfg.getint('Trace_Max', 1000))
+
+# Duplicate message filter, from config. Made once per process, so it remembers messages across runs
+def getDedupFilter(cfg, logger):
+    kind = cfg.get('Dedup_Filter', 'bloom').lower()
+    window = cfg.getint('Dedup_Window', 24*60*60)
+    if kind == 'bloom':
+        f = RotatingBloomFilter(cfg.getint('Dedup_Capacity', 1000000), cfg.getfloat('Dedup_FP_Rate', 0.0001), window)
+    elif kind == 'redis':
+        f = RedisDedup(window)
+    else:
+        return None
+    logger.info('** Duplicate message filter: ' + f.describe())
+    return f
+
+# Adaptive concurrency controller, for the number of bulk worker threads. Directed_Reserved_Threads are on top of these
+def getConcurrencyController(cfg, logger):
+    if not cfg.getboolean('Adaptive_Concurrency', False):
+        return None
+    maxBulk = max(1, cfg.getint('Max_Threads', 16) - cfg.getint('Directed_Reserved_Threads', 4))
+    return ConcurrencyController(max(1, min(cfg.getint('Min_Threads', 4), maxBulk)), maxBulk, interval=cfg.getfloat('Concurrency_Interval', 10),
+        backoff=cfg.getfloat('Concurrency_Backoff', 0.8), logger=logger)
+
+# On-demand sampling profiler, idle until asked for a profile by SIGUSR1 or webReporter
+def getProfiler(cfg, logger):
+    seconds = cfg.getfloat('Profile_Seconds', 30)
+    if seconds <= 0:
+        return None
+    p = Profiler(cfg.get('Logfile', baseProgName() + '.log'), seconds, cfg.getfloat('Profile_Interval', 0.01), logger, Results())
+    p.start()
+    return p
+
+# -----------------------------------------------------------------------------
+# Signal handling: SIGHUP reloads config, SIGTERM (or Ctrl-C) stops taking new mail, drains in-flight threads and exits.
+# SIGUSR1 takes a profile.
+# Handlers only set flags; the main thread acts on them between dispatches, so a reload doesn't pause intake.
+# -----------------------------------------------------------------------------
+
+stopRequested = threading.Event()
+reloadRequested = threading.Event()
+
+def requestStop(signum, frame):
+    stopRequested.set()
+
+def requestProfiling(signum, frame):
+    if profiler:
+        profiler.request()
+
+def requestReload(signum, frame):
+    reloadRequested.set()
+
+# Read config again. Replaces the config as a whole, and only if the new file reads OK, otherwise keeps the old one
+# Returns the new config and run settings, or the current ones if the file can't be read or its settings aren't usable,
+# so a bad edit never becomes the live config
+def reloadConfig(cfg, rs, logger):
+    reloadRequested.clear()
+    try:
+        newCfg = readConfig(configFileName())
+        newRs = getRunSettings(newCfg, logger)
+        if not newRs:
+            raise ValueError('settings not usable')
+        logger.info('** Config reloaded from {}'.format(configFileName()))
+        return newCfg, newRs
+    except Exception as e:
+        logger.error('Config reload failed, keeping current config: ' + str(e))
+        return cfg, rs
+
 # -----------------------------------------------------------------------------
 # Main code
 # -----------------------------------------------------------------------------
@@ -668,17 +837,30 @@ cfg = readConfig(configFileName())
 logger = createLogger(cfg.get('Logfile', baseProgName() + '.log'),
     cfg.getint('Logfile_backupCount', 10))
 
+signal.signal(signal.SIGTERM, requestStop)
+signal.signal(signal.SIGINT, requestStop)
+signal.signal(signal.SIGHUP, requestReload)
+profiler = getProfiler(cfg, logger)
+signal.signal(signal.SIGUSR1, requestProfiling)
+
 if args.directory:
+    dedup = getDedupFilter(cfg, logger)
+    concurrency = getConcurrencyController(cfg, logger)
     if args.f:
-        # Process the inbound directory forever
-        while True:
+        # Process the inbound directory forever, until asked to stop
+        while not stopRequested.is_set():
+            if reloadRequested.is_set():
+                cfg, _ = reloadConfig(cfg, None, logger)
             fnameList = glob.glob(os.path.join(args.directory, '*.msg'))
             if fnameList:
-                consumeFiles(logger, fnameList, cfg)
-            time.sleep(5)
-            cfg = readConfig(configFileName())                  # get config again, in case it's changed
+                cfg = consumeFiles(logger, fnameList, cfg, rescan=lambda: glob.glob(os.path.join(args.directory, '*.msg')),
+                    dedup=dedup, concurrency=concurrency)
+            stopRequested.wait(5)
+            emitLogs(resultsQ)
+        logger.info('** Stopped cleanly')
     else:
         # Just process once
         fnameList = glob.glob(os.path.join(args.directory, '*.msg'))
         if fnameList:
-            consumeFiles(logger, fnameList, cfg)
+            consumeFiles(logger, fnameList, cfg, dedup=dedup, concurrency=concurrency)
+    logging.shutdown()                                          # flush logfile
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+#
+# Duplicate message filter. When PMTA retries a delivery, or the consumer restarts part way through a batch, the same
+# message can arrive again; acting on it twice would send SparkPost duplicate opens, clicks, FBLs and OOBs.
+#
+# Messages are keyed on Message-ID plus recipient, or a hash of other identifying headers if Message-ID is missing.
+# Two filters:
+#   - RotatingBloomFilter: in-process, fixed memory set by capacity and false-positive rate. Remembers between
+#     one and two generations of messages. Doesn't survive a restart, and isn't shared between consumers
+#   - RedisDedup: SET NX with a TTL window per message in Redis, shared by all consumers and surviving restarts,
+#     at the cost of one Redis round trip per message
+#
+import hashlib, math, time, threading
+from email.utils import getaddresses
+
+dedupKeyPfx = 'dedup_'
+
+
+# Who this copy was delivered to: the envelope recipient if the MTA recorded it, else the To: header. Lowercased addresses,
+# sorted, so the same recipient always gives the same string
+def recipient(mail):
+    for k in ['X-Original-To', 'Delivered-To', 'To']:
+        v = mail[k]
+        if v and str(v).strip():
+            return ','.join(sorted(a.lower() for _, a in getaddresses([str(v)]) if a))
+    return ''
+
+# Identity of a message delivery. Message-ID if present, else a hash of headers that together are very likely to be
+# unique, plus the recipient: one message sent to several sink addresses arrives as copies with the same Message-ID,
+# and each copy is a separate delivery to act on
+def messageKey(mail):
+    rcpt = recipient(mail)
+    mid = mail['Message-ID']
+    if mid and str(mid).strip():
+        return str(mid).strip() + ' ' + rcpt
+    h = hashlib.sha1()
+    for k in ['From', 'Date', 'Subject', 'Received']:
+        h.update(str(mail[k]).encode('utf-8', errors='replace') + b'\n')
+    h.update(rcpt.encode('utf-8', errors='replace'))
+    return 'hdr:' + h.hexdigest()
+
+
+# Bit positions for an item, by double hashing as in sketches.py
+def bloomBits(item, m, k):
+    h = hashlib.md5(item.encode('utf-8', errors='replace')).digest()
+    h1 = int.from_bytes(h[:8], 'little')
+    h2 = int.from_bytes(h[8:], 'little') | 1
+    return [(h1 + i * h2) % m for i in range(k)]
+
+
+class BloomFilter():
+    def __init__(self, capacity, fpRate):
+        self.m = max(8, int(-capacity * math.log(fpRate) / (math.log(2) ** 2)))     # bits
+        self.k = max(1, round(self.m / capacity * math.log(2)))                     # hash functions
+        self.bits = bytearray((self.m + 7) // 8)
+        self.count = 0
+
+    def __contains__(self, item):
+        return all(self.bits[b >> 3] & (1 << (b & 7)) for b in bloomBits(item, self.m, self.k))
+
+    def add(self, item):
+        for b in bloomBits(item, self.m, self.k):
+            self.bits[b >> 3] |= 1 << (b & 7)
+        self.count += 1
+
+
+class RotatingBloomFilter():
+    # Two generations, each sized for capacity items. A new generation starts when the current one is full, or older
+    # than window seconds, and the oldest is dropped. Each generation gets half the false-positive budget, as a
+    # lookup checks both
+    def __init__(self, capacity, fpRate, window):
+        self.capacity = capacity
+        self.fpRate = fpRate
+        self.window = window
+        self.lock = threading.Lock()
+        self.current = self._newGen()
+        self.previous = None
+
+    def _newGen(self):
+        self.started = time.time()
+        return BloomFilter(self.capacity, self.fpRate / 2)
+
+    def memoryBytes(self):
+        return 2 * len(self.current.bits)
+
+    def describe(self):
+        return 'Bloom filter, {} messages x 2 generations, false-positive rate {}, {} bytes'.format(self.capacity,
+            self.fpRate, self.memoryBytes())
+
+    # True if this message has been seen before; otherwise remembers it and returns False
+    def seen(self, mail, shareRes):
+        key = messageKey(mail)
+        with self.lock:
+            if key in self.current or (self.previous and key in self.previous):
+                return True
+            if self.current.count >= self.capacity or time.time() - self.started > self.window:
+                self.previous, self.current = self.current, self._newGen()
+            self.current.add(key)
+        return False
+
+
+class RedisDedup():
+    def __init__(self, window):
+        self.window = window
+
+    def describe(self):
+        return 'Redis set, {}s window'.format(self.window)
+
+    def seen(self, mail, shareRes):
+        key = hashlib.sha1(messageKey(mail).encode('utf-8', errors='replace')).hexdigest()
+        return not shareRes.setKey(dedupKeyPfx + key, 1, nx=True, ex=self.window)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+#
+# Priority lanes for inbound mail files.
+#
+# Mail to the directed action subdomains (oob., fbl., openclick., accept.) is usually a customer test waiting for an
+# event, so it shouldn't queue behind a burst of bulk statistical traffic. Files are classified at intake by peeking
+# at the To: header, as processMail does, and the directed lane is always dispatched first. Bulk traffic may only use
+# up to (threads - reserved) workers, so a directed message normally finds a free worker straight away.
+#
+# Messages bigger than a threshold go to a 'large' lane with its own small thread limit, so a burst of them can't
+# fill every worker with a big parsed message. Sizes are known at intake, so the dispatcher can also keep the total
+# size of messages in flight under a memory budget.
+#
+# Per-lane queue depth, dispatch wait and end-to-end latency are kept in memory and written to Redis in batches.
+#
+import os, time, threading, resource
+from collections import deque
+from email import policy
+from email.parser import BytesHeaderParser
+
+directedSubdomains = ('oob', 'fbl', 'openclick', 'accept')
+laneNames = ('directed', 'bulk', 'large')
+maxHeaderBytes = 65536                                          # stop looking for the end of the headers after this
+
+
+# Read just the header block of a mail file, not the body
+def readHeaders(fname):
+    hdr = b''
+    with open(fname, 'rb') as f:
+        for line in f:
+            if line in (b'\n', b'\r\n') or len(hdr) > maxHeaderBytes:
+                break
+            hdr += line
+    return BytesHeaderParser(policy=policy.default).parsebytes(hdr)
+
+# Lane for a mail file. Anything that can't be read or parsed goes to bulk, where processMail will report it
+def classify(fname):
+    try:
+        to = readHeaders(fname)['to']
+        subd = str(to).split('@')[1].split('.')[0]
+        return 'directed' if subd in directedSubdomains else 'bulk'
+    except Exception:
+        return 'bulk'
+
+
+class LaneQueue():
+    def __init__(self, largeBytes=0):
+        self.largeBytes = largeBytes                            # bulk messages bigger than this go to the large lane; 0 = no large lane
+        self.q = {l: deque() for l in laneNames}
+        self.queued = set()
+        self.known = {}                                         # fname -> (lane, arrival time, size), so each file is only read once
+
+    # Add files not already seen, oldest first within each lane. Only the given lanes are queued; files in other
+    # lanes are left for a later run. Returns the number of files queued
+    def add(self, fnames, lanes=laneNames):
+        new = []
+        for fname in fnames:
+            if fname in self.queued:
+                continue
+            if fname not in self.known:
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue                                    # already gone
+                lane = classify(fname)
+                if lane == 'bulk' and self.largeBytes and st.st_size > self.largeBytes:
+                    lane = 'large'
+                self.known[fname] = (lane, st.st_mtime, st.st_size)
+            lane, arrived, size = self.known[fname]
+            if lane in lanes:
+                self.queued.add(fname)
+                new.append((arrived, fname, lane, size))
+        for arrived, fname, lane, size in sorted(new):
+            self.q[lane].append((fname, lane, arrived, size))
+        return len(new)
+
+    def depth(self, lane):
+        return len(self.q[lane])
+
+    def __len__(self):
+        return sum(len(q) for q in self.q.values())
+
+    # Next (fname, lane, arrival time, size) to dispatch, from the lanes allowed a worker now, whose size fits(). Directed
+    # first, otherwise the oldest. None if nothing can go yet
+    def pop(self, allowed, fits):
+        cands = [l for l in laneNames if l in allowed and self.q[l] and fits(self.q[l][0][3])]
+        if not cands:
+            return None
+        lane = 'directed' if 'directed' in cands else min(cands, key=lambda l: self.q[l][0][2])
+        return self.q[lane].popleft()
+
+
+class LaneStats():
+    def __init__(self, flushInterval=5):
+        self.flushInterval = flushInterval
+        self.lock = threading.Lock()
+        self.lastFlush = time.time()
+        self.counts = {}                                        # counter name -> amount to add
+        self.gauges = {}                                        # gauge name -> value to set
+        self.peaks = {}                                         # peak gauge name -> highest value since last flush
+
+    def _add(self, k, n):
+        self.counts[k] = self.counts.get(k, 0) + n
+
+    def _max(self, k, n):
+        self.peaks[k] = max(self.peaks.get(k, 0), n)
+
+    # Called at dispatch, with the lane's remaining depth
+    def dispatched(self, lane, arrived, depth):
+        waitMs = int((time.time() - arrived) * 1000)
+        with self.lock:
+            self._add('lane_{}_messages'.format(lane), 1)
+            self._add('lane_{}_wait_ms'.format(lane), waitMs)
+            self._max('lane_{}_wait_max_ms'.format(lane), waitMs)
+            self.gauges['lane_{}_depth'.format(lane)] = depth
+
+    # Worker thread target: run fn, then record the time from the file's arrival to finishing it
+    def run(self, lane, arrived, fn, *args):
+        try:
+            fn(*args)
+        finally:
+            doneMs = int((time.time() - arrived) * 1000)
+            with self.lock:
+                self._add('lane_{}_latency_ms'.format(lane), doneMs)
+                self._max('lane_{}_latency_max_ms'.format(lane), doneMs)
+
+    # Called at dispatch, with the total size of messages now in flight
+    def memory(self, inFlightBytes):
+        with self.lock:
+            self._max('inflight_bytes_max', inFlightBytes)
+            self.gauges['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss     # kB on Linux
+
+    def setDepths(self, lq):
+        with self.lock:
+            for lane in laneNames:
+                self.gauges['lane_{}_depth'.format(lane)] = lq.depth(lane)
+
+    # Write accumulated stats in one pipeline, if due (or forced). Peaks are running maxima: one is only written when
+    # higher than the value already in Redis, so it holds the highest seen since the counters were last cleared
+    def flush(self, shareRes, force=False):
+        if not force and time.time() - self.lastFlush < self.flushInterval:
+            return
+        with self.lock:
+            counts, gauges, peaks = self.counts, self.gauges, self.peaks
+            self.counts, self.gauges, self.peaks = {}, {}, {}
+            self.lastFlush = time.time()
+        if peaks:
+            peakKeys = [shareRes.rkeyPrefix + 'gauge_' + k for k in peaks]
+            for k, cur in zip(list(peaks), shareRes.r.mget(peakKeys)):
+                if cur is not None and int(cur) >= peaks[k]:
+                    del peaks[k]
+        if counts or gauges or peaks:
+            pipe = shareRes.r.pipeline(transaction=False)
+            for k, n in counts.items():
+                pipe.incrby(shareRes.rkeyPrefix + 'int_' + k, n)
+            for k, v in {**gauges, **peaks}.items():
+                pipe.set(shareRes.rkeyPrefix + 'gauge_' + k, v)
+            pipe.execute()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# Log analytics for consume-mail.log* files, in a single streaming pass per file.
+# Replaces the csvfix.py | grep | csvcut | sort | uniq pipeline in sending-domains.sh
+#
+# Files (plain or .gz) are summarised in parallel across cores. Large plain files are split into byte ranges, aligned
+# to line boundaries, so a single big current logfile still uses all cores. Per-file summaries are cached, keyed on
+# file size and modification time, so re-runs skip logs that haven't changed.
+#
+# Logfile lines look like
+#   2018-06-04 17:56:34,123,root,INFO,inbound/00056dd4a780a5f1.msg,to@example.com,from@example.com,action,action..
+# Note the asctime field contains a comma, so the .msg filename is column 4 (zero based), To: is 5 and From: is 6.
+#
+import os, sys, csv, gzip, json, glob, argparse
+from collections import Counter
+from multiprocessing import Pool
+
+cacheVersion = 1
+chunkBytes = 64 * 1024 * 1024                                   # split plain files bigger than this into ranges
+
+# Names of the engagement steps that openClickMail concatenates into a single '_Open_Click' style field
+engageActions = {'Open', 'OpenAgain', 'Click', 'ClickAgain'}
+
+
+def emptySummary():
+    return {'lines': 0, 'messages': 0, 'senders': Counter(), 'actions': Counter(), 'errors': Counter(), 'hours': Counter()}
+
+
+def mergeSummary(a, b):
+    a['lines'] += b['lines']
+    a['messages'] += b['messages']
+    for k in ['senders', 'actions', 'errors', 'hours']:
+        a[k].update(b[k])
+    return a
+
+
+# Reduce an error string to its class, by cutting off any detail after ':' and dropping words that look like
+# hostnames, addresses or URLs. e.g. '!Tracking domain https://x.example.com blocked' -> '!Tracking domain blocked'
+def errorClass(s):
+    words = [w for w in s.split() if not any(c in w for c in '.@/')]
+    return ' '.join(words).split(':')[0]
+
+
+def countActions(fields, summary):
+    for f in fields:
+        f = f.strip()
+        if not f:
+            continue
+        if f.startswith('_'):
+            # engagement steps, possibly followed by an error string from the tracking endpoint check
+            steps, _, err = f.partition('!')
+            for a in steps.split('_'):
+                if a in engageActions:
+                    summary['actions'][a] += 1
+            if err:
+                summary['errors'][errorClass('!' + err)] += 1
+        elif f.startswith('!'):
+            summary['errors'][errorClass(f)] += 1
+        elif f in ('Accept', 'FBL sent', 'OOB sent'):
+            summary['actions'][f] += 1
+
+
+def summariseLine(line, summary):
+    summary['lines'] += 1
+    if '.msg' not in line:                                      # skip process start / finish lines
+        return
+    row = next(csv.reader([line]))                              # parse each line once
+    if len(row) < 7 or not row[4].endswith('.msg'):
+        return
+    summary['messages'] += 1
+    summary['hours'][row[0][:13]] += 1                          # 'YYYY-MM-DD HH'
+    if '@' in row[6]:
+        summary['senders'][row[6].strip()] += 1
+    countActions(row[7:], summary)
+
+
+def openLog(fname):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rt', errors='replace')
+    return open(fname, 'rt', errors='replace')
+
+
+# Summarise one task, which is either a whole file, or a byte range of a plain file. A range owns every line that
+# starts inside it, so the partial line at the start belongs to the previous range.
+def summariseTask(task):
+    fname, start, end = task
+    summary = emptySummary()
+    if start is None:
+        with openLog(fname) as f:
+            for line in f:
+                summariseLine(line.rstrip('\r\n'), summary)
+    else:
+        with open(fname, 'rb') as f:
+            if start > 0:
+                f.seek(start - 1)
+                f.readline()                                    # skip to the start of the first line we own
+            while f.tell() < end:
+                line = f.readline()
+                if not line:
+                    break
+                summariseLine(line.decode('utf-8', errors='replace').rstrip('\r\n'), summary)
+    return fname, summary
+
+
+def splitTasks(fname, size):
+    if fname.endswith('.gz') or size <= chunkBytes:
+        return [(fname, None, None)]
+    return [(fname, s, min(s + chunkBytes, size)) for s in range(0, size, chunkBytes)]
+
+
+# -----------------------------------------------------------------------------
+# Per-file summary cache
+# -----------------------------------------------------------------------------
+
+def fileSignature(fname):
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def toJson(summary):
+    return {k: (dict(v) if isinstance(v, Counter) else v) for k, v in summary.items()}
+
+
+def fromJson(j):
+    summary = emptySummary()
+    summary['lines'] = j['lines']
+    summary['messages'] = j['messages']
+    for k in ['senders', 'actions', 'errors', 'hours']:
+        summary[k] = Counter(j[k])
+    return summary
+
+
+def loadCache(cacheFile):
+    try:
+        with open(cacheFile) as f:
+            c = json.load(f)
+        if c.get('version') == cacheVersion:
+            return c['files']
+    except (OSError, ValueError, KeyError):
+        pass
+    return {}
+
+
+def saveCache(cacheFile, files):
+    tmpFile = cacheFile + '.tmp'
+    with open(tmpFile, 'w') as f:
+        json.dump({'version': cacheVersion, 'files': files}, f)
+    os.replace(tmpFile, cacheFile)                              # atomic, so concurrent runs never see a partial cache
+
+
+# Returns dict of per-file summaries, computing only those not already in the cache
+def summariseFiles(fnameList, jobs, cacheFile):
+    cache = loadCache(cacheFile) if cacheFile else {}
+    results = {}
+    tasks = []
+    sigs = {}
+    for fname in fnameList:
+        key = os.path.abspath(fname)
+        sigs[fname] = fileSignature(fname)
+        c = cache.get(key)
+        if c and c['sig'] == sigs[fname]:
+            results[fname] = fromJson(c['summary'])
+        else:
+            results[fname] = emptySummary()
+            tasks += splitTasks(fname, sigs[fname][0])
+
+    if tasks:
+        with Pool(processes=jobs) as pool:
+            for fname, summary in pool.imap_unordered(summariseTask, tasks):
+                mergeSummary(results[fname], summary)
+
+    if cacheFile:
+        # merge into the loaded cache, so summaries of files not in this run are kept; drop those whose files are gone
+        newCache = {k: c for k, c in cache.items() if os.path.exists(k)}
+        for fname, summary in results.items():
+            newCache[os.path.abspath(fname)] = {'sig': sigs[fname], 'summary': toJson(summary)}
+        saveCache(cacheFile, newCache)
+    return results
+
+
+# -----------------------------------------------------------------------------
+# Reporting
+# -----------------------------------------------------------------------------
+
+def sendingDomains(senders):
+    domains = Counter()
+    for s, n in senders.items():
+        d = s.rstrip('>').split('@')[-1].strip().lower()
+        domains[d] += n
+    return domains
+
+
+def report(total):
+    hours = {h: {'messages': n, 'rate_per_sec': round(n / 3600, 3)} for h, n in sorted(total['hours'].items())}
+    return {
+        'lines': total['lines'],
+        'messages': total['messages'],
+        'sending_domains': dict(sendingDomains(total['senders']).most_common()),
+        'actions': dict(total['actions'].most_common()),
+        'errors': dict(total['errors'].most_common()),
+        'hours': hours,
+    }
+
+
+# -----------------------------------------------------------------------------
+# Main code
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarise consume-mail logfiles (plain or .gz): sending domains, action counts, error classes and per-hour rates.')
+    parser.add_argument('files', type=str, nargs='*', default=None, help='logfiles to read (default: consume-mail.log*)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of worker processes (default: number of cores)')
+    parser.add_argument('--cache', type=str, default='.logstats-cache.json', help='per-file summary cache (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true', help='ignore and do not write the cache')
+    parser.add_argument('--senders', action='store_true', help='list unique sender addresses per file, like sending-domains.sh used to')
+    args = parser.parse_args()
+
+    files = args.files
+    if not files:
+        files = sorted(f for f in glob.glob('consume-mail.log*') if not f.endswith('.tmp'))
+    files = [f for f in files if os.path.isfile(f)]
+    cacheFile = None if args.no_cache else args.cache
+    results = summariseFiles(files, args.jobs, cacheFile)
+
+    if args.senders:
+        for fname in files:
+            print('{}:'.format(fname))
+            for s in sorted(results[fname]['senders']):
+                print(s)
+    else:
+        total = emptySummary()
+        for fname in files:
+            mergeSummary(total, results[fname])
+        out = report(total)
+        out['files'] = {f: results[f]['messages'] for f in files}
+        json.dump(out, sys.stdout, indent=2)
+        print()
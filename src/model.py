@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+#
+# The statistical model for the "accepted" traffic portion, set up from consume-mail.ini. Used by consume-mail.py, and
+# by simulate.py to check a config offline.
+#
+import configparser
+from datetime import datetime
+from bouncerate import nWeeklyCycle
+
+
+# Signals engagement-recency settings: the To: localpart prefix, the set of days of the month (1-31) on which each final
+# digit 0-9 is opened, and the fraction of digit-days that are active. Open rates are scaled up by 1/density to allow for this
+def getSignalsOpenDays(cfg):
+    signalsTrafficPrefix = cfg.get('Signals_Traffic_Prefix', '')
+    signalsOpenDays = []
+    if signalsTrafficPrefix:
+        maxDayCount = 0
+        activeDigitDays = 0
+        for i in range(0, 10):
+            daystr = cfg.get('Digit'+str(i)+'_Days', 0)
+            dayset = {int(j) for j in daystr.split(',') }
+            signalsOpenDays.append(dayset)            # list of sets
+            maxDayCount = max(maxDayCount, len(dayset))
+            activeDigitDays += len(dayset)
+        activeDigitDensity = activeDigitDays/(10*maxDayCount)
+    else:
+        activeDigitDensity = 1.0
+    return signalsTrafficPrefix, signalsOpenDays, activeDigitDensity
+
+# Set conditional probability in mutable dict P for event a given event b. https://en.wikipedia.org/wiki/Conditional_probability
+def checkSetCondProb(P, a, b, logger):
+    aGivenbName = a + '_Given_' + b
+    PaGivenb = P[a] / P[b]
+    if PaGivenb < 0 or PaGivenb > 1:
+        logger.error('Config file problem: {} and {} implies {} = {}, out of range'.format(a, b, aGivenbName, PaGivenb))
+        return None
+    else:
+        P[aGivenbName] = PaGivenb
+        return True
+
+# For safety, clip values to lie in range 0.0 <= n <= 1.0. If a list is given, the name of any value that was clipped is added to it
+def probClip(n, clipped=None, name=''):
+    c = max(0.0, min(1.0, n))
+    if clipped is not None and c != n:
+        clipped.append('{}={:.4g}'.format(name, n))
+    return c
+
+# Take the overall percentages and adjust them according to how much traffic we expect to receive. This app would not see
+# the 'upstream handled' traffic percentage as PMTA blackholes / in-band-bounces this automatically via PMTA config, not in this application
+# Express all values as probabilities 0 <= p <= 1.0
+#
+# For Signals, scale the open factor to allow for the filtering by active digit density
+#
+# t is the (UTC) time to get the probabilities for, default now. If clipped is a list, values clipped by probClip are added to it
+def getBounceProbabilities(cfg, activeDigitDensity, logger, t=None, clipped=None):
+    try:
+        thisAppTraffic  = 1 - cfg.getfloat('Upstream_Handled') / 100
+        P = {
+            'OOB'       : cfg.getfloat('OOB_percent') / 100 / thisAppTraffic,
+            'FBL'       : cfg.getfloat('FBL_percent') / 100 / thisAppTraffic,
+            'Open'      : cfg.getfloat('Open_percent') / 100 / thisAppTraffic,
+            'OpenAgain' : cfg.getfloat('Open_Again_percent') / 100 / thisAppTraffic,
+            'Click'     : cfg.getfloat('Click_percent') / 100 / thisAppTraffic,
+            'ClickAgain': cfg.getfloat('Click_Again_percent') / 100 / thisAppTraffic
+        }
+        # Adjust open rates according to Signals periodic traffic profile, if present
+        weeklyCycleOpenList = cfg.get('Weekly_Cycle_Open_Rate', '1.0').split(',')
+        weeklyCycleOpenRate = [float(i) for i in weeklyCycleOpenList]
+        todayOpenFactor, _ = nWeeklyCycle(weeklyCycleOpenRate, t or datetime.utcnow())
+        todayOpenFactor = probClip(todayOpenFactor/activeDigitDensity, clipped, 'OpenFactor')
+        for k in ['Open', 'OpenAgain', 'Click', 'ClickAgain']:
+            P[k] = probClip(P[k] * todayOpenFactor, clipped, k)
+
+        # calculate conditional open & click probabilities, given a realistic state sequence would be
+        # Open?
+        #  - Maybe OpenAgain?
+        #  - Maybe Click?
+        #     - Maybe ClickAgain?
+        if checkSetCondProb(P, 'OpenAgain', 'Open', logger) \
+                and checkSetCondProb(P, 'Click', 'Open', logger) \
+                and checkSetCondProb(P, 'ClickAgain', 'Click', logger):
+            return P
+        else:
+            return None
+    except (ValueError, configparser.Error) as e:
+        logger.error('Config file problem: '+str(e))
+        return None
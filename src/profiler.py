@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+#
+# On-demand sampling profiler for the running consumer, so hot spots can be found without restarting it under a
+# profiler. A profile is started by SIGUSR1, or by webReporter's /admin/profile endpoint via a request key in Redis.
+#
+# For a fixed time, the stacks of all other threads are sampled with sys._current_frames(), and aggregated into
+#   <logfile>.profile-<time>.collapsed  - collapsed stacks, one "frame;frame;frame count" line each, for flamegraph.pl
+#                                          or speedscope
+#   <logfile>.profile-<time>.top.txt    - functions with the most samples, self (on top of the stack) and total
+# The top functions report is also kept in Redis, for webReporter.
+#
+# When no profile is running, the profiler thread is just waiting on an Event, checking Redis every few seconds.
+#
+import os, sys, time, json, threading
+from collections import Counter
+from results import timeStr
+
+requestKey = 'profile_request'
+lastKey = 'profile_last'
+topN = 40
+
+
+def frameName(f):
+    c = f.f_code
+    return '{} ({}:{})'.format(c.co_name, os.path.basename(c.co_filename), c.co_firstlineno)
+
+# Stack of a frame as a list of names, outermost first
+def stackOf(f):
+    s = []
+    while f:
+        s.append(frameName(f))
+        f = f.f_back
+    s.reverse()
+    return s
+
+
+class Profiler():
+    def __init__(self, logfile, seconds, interval, logger, shareRes=None, pollInterval=5):
+        self.logfile = logfile
+        self.seconds = seconds                                  # default profile length
+        self.interval = interval                                # time between samples
+        self.logger = logger
+        self.shareRes = shareRes                                # if set, watch Redis for requests from webReporter
+        self.pollInterval = pollInterval
+        self.requested = threading.Event()
+        self.requestSeconds = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+        self.thread.start()
+
+    # Safe to call from a signal handler
+    def request(self, seconds=None):
+        self.requestSeconds = seconds
+        self.requested.set()
+
+    def checkRedis(self):
+        if not self.shareRes:
+            return
+        try:
+            v = self.shareRes.getKey(requestKey)
+            if v is not None:
+                self.shareRes.r.delete(self.shareRes.rkeyPrefix + requestKey)
+                self.request(float(v) if v else None)
+        except Exception:
+            pass                                                # Redis hiccup; try again next poll
+
+    def run(self):
+        while True:
+            if not self.requested.wait(self.pollInterval):
+                self.checkRedis()
+                continue
+            self.requested.clear()
+            seconds = self.requestSeconds or self.seconds
+            try:
+                self.logger.info('** Profiling all threads for {}s'.format(seconds))
+                stacks, n = self.sample(seconds)
+                self.report(stacks, n, seconds)
+            except Exception as e:
+                self.logger.error('Profiler: ' + str(e))
+
+    # Returns Counter of collapsed stack -> sample count, and number of sampling passes
+    def sample(self, seconds):
+        me = threading.get_ident()
+        stacks = Counter()
+        n = 0
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            for ident, f in sys._current_frames().items():
+                if ident != me:
+                    stacks[';'.join(stackOf(f))] += 1
+            n += 1
+            time.sleep(self.interval)
+        return stacks, n
+
+    def report(self, stacks, n, seconds):
+        base = '{}.profile-{}'.format(self.logfile, time.strftime('%Y%m%dT%H%M%S'))
+        with open(base + '.collapsed', 'w') as f:
+            for s, c in stacks.most_common():
+                f.write('{} {}\n'.format(s, c))
+
+        selfCount, totalCount = Counter(), Counter()
+        for s, c in stacks.items():
+            frames = s.split(';')
+            selfCount[frames[-1]] += c
+            for fn in set(frames):                              # count recursive functions once per stack
+                totalCount[fn] += c
+        samples = sum(stacks.values())
+        lines = ['Profile at {}, {}s, {} passes, {} thread samples'.format(timeStr(time.time()), seconds, n, samples), '',
+            '{:>8} {:>7} {:>8} {:>7}  {}'.format('self', 'self%', 'total', 'total%', 'function')]
+        for fn, c in selfCount.most_common(topN):
+            lines.append('{:8d} {:6.1f}% {:8d} {:6.1f}%  {}'.format(c, 100 * c / samples, totalCount[fn], 100 * totalCount[fn] / samples, fn))
+        top = '\n'.join(lines) + '\n'
+        with open(base + '.top.txt', 'w') as f:
+            f.write(top)
+        self.logger.info('** Profile written to {}.collapsed and {}.top.txt'.format(base, base))
+        if self.shareRes:
+            try:
+                self.shareRes.setKey(lastKey, json.dumps({'files': [base + '.collapsed', base + '.top.txt'], 'top': top}))
+            except Exception:
+                pass
+
+
+# Ask a running consumer (via Redis) to take a profile
+def requestProfile(shareRes, seconds):
+    return shareRes.setKey(requestKey, str(seconds), ex=60)
+
+def getLastProfile(shareRes):
+    v = shareRes.getKey(lastKey)
+    return json.loads(v) if v else None
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# Replay archived messages into the sink at a controlled rate, to check capacity before customer load tests.
+#
+# Reads .msg files from a corpus directory (by default Done_Msg_File_Dest from the config file) and either writes them
+# into a spool directory, as PMTA would, or sends them over SMTP to an ingest listener. The rate is either constant, or
+# follows a recorded messages-per-minute profile, from the ts_ keys in Redis or a JSON file of the same format as
+# /json/ts-messages.
+#
+# Can run fully offline: --stub-smtp starts a local listener that accepts mail and writes it to the spool directory.
+#
+import os, sys, time, glob, json, uuid, re, random, argparse, smtplib, socketserver, threading
+from datetime import datetime
+from common import readConfig, configFileName, xstr
+
+# -----------------------------------------------------------------------------
+# Corpus and message rewriting
+# -----------------------------------------------------------------------------
+
+def loadCorpus(corpusDir):
+    corpus = []
+    for fname in sorted(glob.glob(os.path.join(corpusDir, '*.msg'))):
+        with open(fname, 'rb') as f:
+            corpus.append(f.read())
+    return corpus
+
+messageIdRe = re.compile(rb'^Message-ID:[^\r\n]*(\r?\n[ \t][^\r\n]*)*', re.IGNORECASE | re.MULTILINE)
+
+# Give the message a new, unique Message-ID: header, working on the raw bytes so nothing else in the message changes.
+# Only the header section is searched, so a forwarded message/rfc822 part is left alone.
+def rewriteMessageId(msg):
+    newId = 'Message-ID: <replay.{}@bouncy-sink.replay>'.format(uuid.uuid4().hex).encode('ascii')
+    hdrEnd = re.search(rb'\r?\n\r?\n', msg)
+    hdrEnd = hdrEnd.start() if hdrEnd else len(msg)
+    hdrs, body = msg[:hdrEnd], msg[hdrEnd:]
+    hdrs, n = messageIdRe.subn(newId, hdrs, count=1)
+    if n == 0:
+        hdrs = newId + b'\n' + hdrs
+    return hdrs + body
+
+def envelope(msg):
+    hdrEnd = re.search(rb'\r?\n\r?\n', msg)
+    hdrs = msg[:hdrEnd.start() if hdrEnd else len(msg)].decode('utf-8', errors='replace')
+    def addr(name):
+        m = re.search(r'^' + name + r':.*?<?([^<>\s]+@[^<>\s]+)>?', hdrs, re.IGNORECASE | re.MULTILINE)
+        return m.group(1) if m else ''
+    return addr('Return-Path') or addr('From'), addr('To')
+
+# -----------------------------------------------------------------------------
+# Outputs
+# -----------------------------------------------------------------------------
+
+# Write into the spool directory. Written under a temporary name then renamed, so the consumer never sees a partial file
+class SpoolWriter():
+    def __init__(self, spoolDir):
+        self.spoolDir = spoolDir
+        os.makedirs(spoolDir, exist_ok=True)
+
+    def send(self, msg):
+        name = '{:016x}'.format(random.getrandbits(64))
+        tmpName = os.path.join(self.spoolDir, name + '.tmp')
+        with open(tmpName, 'wb') as f:
+            f.write(msg)
+        os.rename(tmpName, os.path.join(self.spoolDir, name + '.msg'))
+
+    def close(self):
+        pass
+
+# Send to an SMTP ingest listener, over a persistent connection
+class SmtpSender():
+    def __init__(self, host, port, timeout):
+        self.host, self.port, self.timeout = host, port, timeout
+        self.smtp = None
+
+    def send(self, msg):
+        mailFrom, rcptTo = envelope(msg)
+        if not self.smtp:
+            self.smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            self.smtp.sendmail(mailFrom, rcptTo, msg)
+        except smtplib.SMTPServerDisconnected:
+            self.smtp = None                                # reconnect on the next message
+            raise
+
+    def close(self):
+        if self.smtp:
+            self.smtp.quit()
+
+# -----------------------------------------------------------------------------
+# Stub SMTP listener, for offline runs. Accepts everything; writes messages to a SpoolWriter, if given
+# -----------------------------------------------------------------------------
+
+class StubSmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, s):
+        self.wfile.write(s.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 stub ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode('ascii', errors='replace').strip().upper()
+            if cmd.startswith('EHLO') or cmd.startswith('HELO'):
+                self.reply('250 stub')
+            elif cmd.startswith('DATA'):
+                self.reply('354 go ahead')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line.rstrip(b'\r\n') == b'.':
+                        break
+                    data.append(line[1:] if line.startswith(b'..') else line)    # undo dot-stuffing
+                if self.server.spool:
+                    self.server.spool.send(b''.join(data))
+                self.reply('250 OK')
+            elif cmd.startswith('QUIT'):
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 OK')                            # MAIL, RCPT, RSET, NOOP
+
+def startStubSmtp(port, spool):
+    server = socketserver.ThreadingTCPServer(('localhost', port), StubSmtpHandler)
+    server.daemon_threads = True
+    server.spool = spool
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# -----------------------------------------------------------------------------
+# Rate shaping
+# -----------------------------------------------------------------------------
+
+# Send times (seconds from start) for a constant rate
+def constantSchedule(rate, count):
+    return [i / rate for i in range(count)]
+
+# Time of a profile point, from the ISO format UTC 'time' values that timeStr gives
+def profileTime(p):
+    return datetime.strptime(p['time'][:19], '%Y-%m-%dT%H:%M:%S')
+
+# Send times following a per-minute profile [{'time': .., 'messages': n}, ..], each minute compressed by speedup.
+# Minutes missing from the profile (no traffic recorded) are idle gaps in the replay too
+def profileSchedule(profile, speedup, scale):
+    sched = []
+    window = 60.0 / speedup
+    if not profile:
+        return sched
+    first = profileTime(profile[0])
+    for p in profile:
+        j = (profileTime(p) - first).total_seconds() / 60     # minutes from the start
+        n = int(round(p['messages'] * scale))
+        sched += [(j + i / n) * window for i in range(n)]
+    return sched
+
+def loadProfile(profileSrc):
+    if profileSrc == 'redis':
+        from results import Results
+        return Results().getArrayResults('ts_', 'messages')
+    with open(profileSrc) as f:
+        return json.load(f)
+
+# Consumer lag, as seen from the spool directory: number of messages waiting, and age of the oldest (seconds)
+def spoolLag(spoolDir):
+    waiting = glob.glob(os.path.join(spoolDir, '*.msg'))
+    oldest = 0.0
+    now = time.time()
+    for fname in waiting:
+        try:
+            oldest = max(oldest, now - os.stat(fname).st_mtime)
+        except FileNotFoundError:
+            pass                                                # consumed while we were looking
+    return len(waiting), oldest
+
+def replay(corpus, sched, out, rewrite, spoolDir, reportInterval, consumerRes=None):
+    sent, errors = 0, 0
+    startTime = time.time()
+    nextReport = startTime + reportInterval
+    for i, due in enumerate(sched):
+        now = time.time()
+        if startTime + due > now:
+            time.sleep(startTime + due - now)
+        msg = corpus[i % len(corpus)]
+        if rewrite:
+            msg = rewriteMessageId(msg)
+        try:
+            out.send(msg)
+            sent += 1
+        except Exception as e:
+            errors += 1
+            print('!Send error: {}'.format(e), file=sys.stderr)
+        if time.time() >= nextReport:
+            report(startTime, sent, errors, i + 1, due, spoolDir, consumerRes)
+            nextReport += reportInterval
+    report(startTime, sent, errors, len(sched), sched[-1] if sched else 0, spoolDir, consumerRes)
+    return sent, errors
+
+def report(startTime, sent, errors, done, due, spoolDir, consumerRes=None):
+    runTime = time.time() - startTime
+    targetRate = (0 if due == 0 else done / due)
+    achievedRate = (0 if runTime == 0 else sent / runTime)
+    behind = max(0.0, runTime - due)
+    s = 'time(s)={:.1f},sent {},errors {},target rate={:.1f}/s,achieved rate={:.1f}/s,behind schedule(s)={:.2f}'.format(
+        runTime, sent, errors, targetRate, achievedRate, behind)
+    if spoolDir:
+        waiting, oldest = spoolLag(spoolDir)
+        s += ',consumer lag: waiting {},oldest(s)={:.1f}'.format(waiting, oldest)
+    if consumerRes:
+        s += ',consumer peak RSS(MB)={:.1f},in-flight peak(MB)={:.1f}'.format(consumerRes.getKey_gauge('peak_rss_kb') / 1024,
+            consumerRes.getKey_gauge('inflight_bytes_max') / (1024 * 1024))
+    print(s, flush=True)
+
+# -----------------------------------------------------------------------------
+# Main code
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay archived .msg files into a spool directory or SMTP listener at a controlled rate.')
+    parser.add_argument('--corpus', type=str, help='directory of .msg files to replay (default: Done_Msg_File_Dest from {})'.format(configFileName()))
+    parser.add_argument('--spool', type=str, help='spool directory to write .msg files into, as PMTA would')
+    parser.add_argument('--smtp', type=str, help='host:port of an SMTP ingest listener to send to')
+    parser.add_argument('--stub-smtp', action='store_true', help='start a local stub listener on the --smtp port, writing to --spool if given')
+    parser.add_argument('--rate', type=float, default=10.0, help='constant target rate, messages per second (default: %(default)s)')
+    parser.add_argument('--count', type=int, default=1000, help='number of messages to send at constant rate (default: %(default)s)')
+    parser.add_argument('--profile', type=str, help='follow a messages-per-minute profile: "redis" for the recorded ts_ keys, or a JSON file')
+    parser.add_argument('--speedup', type=float, default=1.0, help='time compression factor for --profile (default: %(default)s)')
+    parser.add_argument('--scale', type=float, default=1.0, help='volume scale factor for --profile (default: %(default)s)')
+    parser.add_argument('--rewrite-message-id', action='store_true', help='give each replayed message a new unique Message-ID:')
+    parser.add_argument('--consumer-stats', action='store_true', help='also report the consumer\'s peak RSS and in-flight message size, from Redis')
+    parser.add_argument('--report-interval', type=float, default=5.0, help='seconds between progress reports (default: %(default)s)')
+    args = parser.parse_args()
+
+    corpusDir = args.corpus
+    if not corpusDir:
+        cfg = readConfig(configFileName())
+        corpusDir = xstr(cfg.get('Done_Msg_File_Dest'))
+    corpus = loadCorpus(corpusDir)
+    if not corpus:
+        print('No .msg files found in corpus directory {}'.format(corpusDir), file=sys.stderr)
+        sys.exit(1)
+
+    spool = SpoolWriter(args.spool) if args.spool else None
+    if args.smtp:
+        host, port = args.smtp.rsplit(':', 1)
+        if args.stub_smtp:
+            startStubSmtp(int(port), spool)
+        out = SmtpSender(host, int(port), timeout=30)
+    elif spool:
+        out = spool
+    else:
+        parser.error('need --spool and/or --smtp')
+
+    if args.profile:
+        sched = profileSchedule(loadProfile(args.profile), args.speedup, args.scale)
+    else:
+        sched = constantSchedule(args.rate, args.count)
+    print('Replaying {} messages from a corpus of {}'.format(len(sched), len(corpus)), flush=True)
+    consumerRes = None
+    if args.consumer_stats:
+        from results import Results
+        consumerRes = Results()
+    try:
+        replay(corpus, sched, out, args.rewrite_message_id, args.spool, args.report_interval, consumerRes)
+    finally:
+        out.close()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+#
+# Access functions for shared results data held in Redis. Used by the consumer, the web reporter and the chk_ tools.
+# Kept free of the web stack, so the consumer starts quickly and small.
+#
+# Author: Steve Tuck.  (c) 2018 SparkPost
+#
+# Pre-requisites:
+#   pip3 install redis
+#
+import os, redis
+from datetime import datetime, timezone
+from tracer import span
+
+appName = 'consume-mail'
+fetchBatch = 500                                                        # keys per MGET, when reading many counters
+
+def timeStr(t):
+    utc = datetime.fromtimestamp(t, timezone.utc)
+    return datetime.isoformat(utc, sep='T', timespec='seconds')
+
+class Results():
+    def __init__(self, resultsKey=None, conn=None):
+        # Set up a persistent connection to redis results, or share an existing one
+        if conn:
+            self.r = conn
+        else:
+            redisUrl = os.getenv('REDIS_URL', default='redis://localhost')  # Env var is set by Heroku; will be unset when local
+            self.r = redis.from_url(redisUrl, socket_timeout=5)             # shorten timeout so doesn't hang forever
+        if resultsKey is None:
+            resultsKey = os.getenv('RESULTS_KEY', default='0')              # allows unique app instances if needed (e.g. Heroku)
+        self.resultsKey = resultsKey
+        self.rkeyPrefix = appName + ':' + resultsKey + ':'
+
+    # Access to Redis data
+    def getKey(self, k):
+        with span('redis', 'get'):
+            res = self.r.get(self.rkeyPrefix + k)
+        return res
+
+    # returns True if data written back to Redis OK. v is a value to write, optional keyword args are passed on down
+    def setKey(self, k, v, **kwargs):
+        with span('redis', 'set'):
+            ok = self.r.set(self.rkeyPrefix + k, v, **kwargs)
+        return ok
+
+    # collect basic metrics, i.e. started_running, any keys prefixed int_ (counters) and gauge_ (levels and peaks).
+    # Provide default value for startedRunning
+    def getMatchingResults(self):
+        res = {'startedRunning': self.getStartedRunning()}
+        res.update(self.getIntKeys('int_'))
+        res.update(self.getIntKeys('gauge_'))
+        return res
+
+    def getStartedRunning(self):
+        stR = self.getKey('startedRunning')
+        if stR:
+            return stR.decode('utf-8')
+        else:
+            return 'Not yet - waiting for scheduled running to begin'   # default data
+
+    # dict of name -> int value for keys with the given type prefix, e.g. int_
+    def getIntKeys(self, typePfx):
+        return {k: int(v) for k, v in self.getMatchingKeys(self.rkeyPrefix + typePfx)}     # use as int
+
+    # Scan for keys with the given prefix, and fetch their values in pipelined batches rather than one GET per key.
+    # Returns list of (key with prefix stripped, value str) pairs
+    def getMatchingKeys(self, pfx):
+        keys = list(self.r.scan_iter(match=pfx+'*', count=1000))
+        res = []
+        for i in range(0, len(keys), fetchBatch):
+            batch = keys[i:i+fetchBatch]
+            for k, v in zip(batch, self.r.mget(batch)):
+                if v is not None:                                       # may have expired / been deleted since the scan
+                    res.append((k.decode('utf-8')[len(pfx):], v.decode('utf-8')))
+        return res
+
+    # wrapper functions for integer type counters. Mark type in key name, as all redis objs are natively Bytes
+    def incrementKey(self, k):
+        with span('redis', 'incr'):
+            self.r.incr(self.rkeyPrefix + 'int_' + k)
+
+    def decrementKey(self, k):
+        self.r.decr(self.rkeyPrefix + 'int_' + k)
+
+    def getKey_int(self, k):
+        v = self.r.get(self.rkeyPrefix + 'int_' + k)                    # force conversion on way out
+        if v:
+            v2 = v.decode('utf-8')
+            return int(v2) if v2.isnumeric() else 0
+        else:
+            return 0
+
+    def setKey_int(self, k, v):
+        ok = self.r.set(self.rkeyPrefix + 'int_' + k, v)                # allow redis to set type on way in
+        return ok
+
+    # Gauges are values that are set rather than added to, such as a queue depth or a peak. They have their own prefix,
+    # so the cluster view can take the max across instances rather than the sum
+    def getKey_gauge(self, k):
+        v = self.r.get(self.rkeyPrefix + 'gauge_' + k)
+        return int(v) if v else 0
+
+    def setKey_gauge(self, k, v):
+        return self.r.set(self.rkeyPrefix + 'gauge_' + k, v)
+
+    def incrementTimeSeries(self, k):
+        with span('redis', 'incr'):
+            self.r.incr(self.rkeyPrefix + 'ts_' + k)
+
+    def delTimeSeriesOlderThan(self, t):
+        for i in ['ts_*', 'ps_*']:
+            for k in self.r.scan_iter(match=self.rkeyPrefix + i):
+                idx = k.decode('utf-8') [len(self.rkeyPrefix):]         # strip the app prefix
+                ts = int(idx[len('ts_'):])                              # got the metric's timestamp as int
+                if ts < t:
+                    self.r.delete(k)
+
+    # Latest per-minute time-series points, oldest first, as for getArrayResults but without a scan
+    def getRecentTimeSeries(self, t, minutes, keyName):
+        m = [(int(t) // 60 - i) * 60 for i in range(minutes - 1, -1, -1)]
+        vals = self.r.mget([self.rkeyPrefix + 'ts_' + str(i) for i in m])
+        return [{'time': timeStr(i), keyName: int(v) if v else 0} for i, v in zip(m, vals)]
+
+    def getArrayResults(self, pfx, keyName):
+        t = {}
+        for idx, v in self.getMatchingKeys(self.rkeyPrefix + pfx):
+            unixTime = (int(idx) // 60) * 60                            # round it to per-minute resolution (so we get matches) - may be lossy
+            ascTime = timeStr(unixTime)
+            t[ascTime] = int(v)                                         # build dict of (time / value) pairs
+        res = []
+        for t, v in sorted(t.items()):
+            res.append( {'time' : t, keyName: v } )
+        return res
+
+
+# -----------------------------------------------------------------------------
+# Cluster-wide views, across all sink instances (RESULTS_KEY values) sharing this Redis
+# -----------------------------------------------------------------------------
+
+# Find the RESULTS_KEY of each instance, from the startedRunning key each one sets on its first run
+def discoverInstances(r):
+    pfx = appName + ':'
+    sfx = ':startedRunning'
+    inst = set()
+    for k in r.scan_iter(match=pfx + '*' + sfx, count=1000):
+        inst.add(k.decode('utf-8')[len(pfx):-len(sfx)])
+    return sorted(inst)
+
+# Merged counter totals and gauge maxima, plus the per-instance breakdown
+def getClusterResults(shareRes):
+    instances = {}
+    total = {}
+    for i in discoverInstances(shareRes.r):
+        inst = Results(resultsKey=i, conn=shareRes.r)
+        st = inst.getStartedRunning()
+        counters, gauges = inst.getIntKeys('int_'), inst.getIntKeys('gauge_')
+        instances[i] = {'startedRunning': st, **counters, **gauges}
+        total['startedRunning'] = min(total.get('startedRunning', st), st)     # earliest; ISO format times sort as strings
+        for k, v in counters.items():
+            total[k] = total.get(k, 0) + v
+        for k, v in gauges.items():
+            total[k] = max(total.get(k, v), v)
+    return {'total': total, 'instances': instances}
+
+# Merged per-minute time series, plus the per-instance breakdown
+def getClusterArrayResults(shareRes, pfx, keyName):
+    instances = {}
+    total = {}
+    for i in discoverInstances(shareRes.r):
+        res = Results(resultsKey=i, conn=shareRes.r).getArrayResults(pfx, keyName)
+        instances[i] = res
+        for p in res:
+            total[p['time']] = total.get(p['time'], 0) + p[keyName]
+    return {'total': [{'time': t, keyName: v} for t, v in sorted(total.items())], 'instances': instances}
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+#
+# Deferred engagement: opens and clicks are decided when a message is processed, but happen later.
+#
+# The consumer turns its open / click decisions into future events, with delays drawn from configurable distributions,
+# and adds them to a Redis sorted set scored by due time. That set is the timer heap; it survives restarts, and can be
+# shared by several executors. Parsing workers no longer wait on tracking endpoints, and the http load is spread out
+# over time rather than arriving in bursts at delivery time.
+#
+# Run this script with -f to fire the events as they come due.
+#
+import sys, json, time, uuid, math, random, signal, threading, argparse
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from common import readConfig, createLogger, baseProgName
+from results import Results
+from sketches import DimensionStats, MessageStats
+from tracking import isSparkPostTrackingEndpoint, touchEndPoint
+
+schedKey = 'sched_engage'
+
+# Delay distribution from a config string. Returns a function giving a delay in seconds
+#   fixed:30            always 30s
+#   uniform:60:600      uniform between 60s and 600s
+#   exp:300             exponential, mean 300s
+#   lognorm:1800:1.0    log-normal, median 1800s, shape (sigma) 1.0. Typical of real time-to-open
+def delayDist(spec):
+    kind, *params = spec.strip().split(':')
+    p = [float(i) for i in params]
+    if kind == 'fixed':
+        return lambda: p[0]
+    elif kind == 'uniform':
+        return lambda: random.uniform(p[0], p[1])
+    elif kind == 'exp':
+        return lambda: random.expovariate(1.0 / p[0]) if p[0] > 0 else 0.0
+    elif kind == 'lognorm':
+        return lambda: random.lognormvariate(math.log(p[0]), p[1])
+    else:
+        raise ValueError('Unknown delay distribution ' + spec)
+
+
+# Collect the open-pixel and link URLs from the html body, without fetching anything
+class TrackingUrlParser(HTMLParser):
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.opens = []
+        self.clicks = []
+
+    def handle_starttag(self, tag, attrs):
+        for attrName, attrValue in attrs:
+            if tag == 'img' and attrName == 'src':
+                self.opens.append(attrValue)
+            elif tag == 'a' and attrName == 'href':
+                self.clicks.append(attrValue)
+
+
+class EngagementScheduler():
+    def __init__(self, cfg):
+        self.openDelay = delayDist(cfg.get('Engage_Open_Delay', 'lognorm:1800:1.0'))
+        self.openAgainDelay = delayDist(cfg.get('Engage_Open_Again_Delay', 'exp:3600'))
+        self.clickDelay = delayDist(cfg.get('Engage_Click_Delay', 'exp:60'))
+        self.clickAgainDelay = delayDist(cfg.get('Engage_Click_Again_Delay', 'exp:600'))
+
+    # open / open again / click / click again logic, as per conditional probabilities, as openClickMail does inline.
+    # Returns the actions string for logging
+    def openClick(self, mail, probs, shareRes, userAgent):
+        ll = ''
+        bd = mail.get_body(('html',))
+        if bd:  # if no body to parse, ignore
+            p = TrackingUrlParser()
+            p.feed(bd.get_content())
+            tOpen = time.time() + self.openDelay()
+            events = [self.event('open', p.opens, userAgent, tOpen)]
+            ll += '_Open'
+            shareRes.incrementKey('open')
+            if random.random() <= probs['OpenAgain_Given_Open']:
+                events.append(self.event('open_again', p.opens, userAgent, tOpen + self.openAgainDelay()))
+                ll += '_OpenAgain'
+                shareRes.incrementKey('open_again')
+            if random.random() <= probs['Click_Given_Open']:
+                tClick = tOpen + self.clickDelay()
+                events.append(self.event('click', p.clicks, userAgent, tClick))
+                ll += '_Click'
+                shareRes.incrementKey('click')
+                if random.random() <= probs['ClickAgain_Given_Click']:
+                    events.append(self.event('click_again', p.clicks, userAgent, tClick + self.clickAgainDelay()))
+                    ll += '_ClickAgain'
+                    shareRes.incrementKey('click_again')
+            self.schedule(shareRes, events)
+            ll += ',Scheduled'
+        return ll
+
+    def event(self, kind, urls, userAgent, due):
+        return {'id': uuid.uuid4().hex, 'kind': kind, 'urls': urls, 'ua': userAgent, 'due': due}
+
+    def schedule(self, shareRes, events):
+        pipe = shareRes.r.pipeline(transaction=False)
+        for e in events:
+            pipe.zadd(shareRes.rkeyPrefix + schedKey, {json.dumps(e): e['due']})
+        pipe.execute()
+
+
+# -----------------------------------------------------------------------------
+# Executor
+# -----------------------------------------------------------------------------
+
+# Take up to batch events that are due. An event is only fired by the executor that removes it from the set, so
+# several executors can share one schedule safely
+def claimDue(shareRes, now, batch):
+    key = shareRes.rkeyPrefix + schedKey
+    members = shareRes.r.zrangebyscore(key, '-inf', now, start=0, num=batch)
+    if not members:
+        return []
+    pipe = shareRes.r.pipeline(transaction=False)
+    for m in members:
+        pipe.zrem(key, m)
+    return [json.loads(m) for m, ok in zip(members, pipe.execute()) if ok]
+
+# Seconds until the next event is due, or None if there are none
+def nextDue(shareRes, now):
+    first = shareRes.r.zrange(shareRes.rkeyPrefix + schedKey, 0, 0, withscores=True)
+    return (first[0][1] - now) if first else None
+
+threadLocal = threading.local()
+
+# Persistent 'requests' session per executor thread, for speed
+def threadSession():
+    if not hasattr(threadLocal, 'session'):
+        import requests
+        threadLocal.session = requests.session()
+    return threadLocal.session
+
+def fireEvent(e, shareRes, dimStats, openClickTimeout, trackingDomainsAllowlist):
+    lateness = time.time() - e['due']
+    msgRes = MessageStats(shareRes, dimStats, [])
+    action = 'open' if e['kind'] in ('open', 'open_again') else 'click'
+    ll = '{},{},late(s)={:.1f}'.format(e['id'], e['kind'], lateness)
+    try:
+        s = threadSession()
+        for url in e['urls']:
+            isSP, err = isSparkPostTrackingEndpoint(s, url, msgRes, openClickTimeout, trackingDomainsAllowlist)
+            if isSP:
+                touchEndPoint(s, url, openClickTimeout, e['ua'])
+                msgRes.recordDimension('tracking_host', urlparse(url).netloc, action)
+            else:
+                msgRes.incrementKey(action + '_url_not_sparkpost')
+                msgRes.recordDimension('tracking_host', urlparse(url).netloc, action + '_url_not_sparkpost')
+            if err:
+                ll += ',' + err
+        shareRes.incrementKey('engage_fired')
+    except Exception as err:
+        shareRes.incrementKey('engage_error')
+        ll += ',!Exception: ' + str(err)
+    return ll
+
+
+# -----------------------------------------------------------------------------
+# Main code
+# -----------------------------------------------------------------------------
+
+stopRequested = threading.Event()
+
+def requestStop(signum, frame):
+    stopRequested.set()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fire deferred opens and clicks scheduled by consume-mail.py (Engagement_Scheduler = true) as they come due.')
+    parser.add_argument('-f', action='store_true', help='Keep firing events forever, as they come due')
+    args = parser.parse_args()
+
+    cfg = readConfig('consume-mail.ini')
+    logger = createLogger(baseProgName() + '.log', cfg.getint('Logfile_backup_count', 10))
+    signal.signal(signal.SIGTERM, requestStop)
+    signal.signal(signal.SIGINT, requestStop)
+
+    shareRes = Results()
+    if not cfg.getboolean('Engagement_Scheduler', False):
+        logger.info('** Engagement_Scheduler is off, executor not needed; {} events pending'.format(shareRes.r.zcard(shareRes.rkeyPrefix + schedKey)))
+        sys.exit(0)
+    width = cfg.getint('Dimension_Stats_Width', 1024)
+    dimStats = DimensionStats(width=width, depth=cfg.getint('Dimension_Stats_Depth', 4), topK=cfg.getint('Dimension_Stats_Top_K', 100),
+        batchSize=cfg.getint('Dimension_Stats_Batch', 500)) if width > 0 else None
+    maxThreads = cfg.getint('Engage_Threads', 16)
+    openClickTimeout = cfg.getint('Open_Click_Timeout', 30)
+    trackingDomainsAllowlist = cfg.get('Tracking_Domains_Allowlist').replace(' ','').split(',')
+    logger.info('** Engagement executor starting with {} threads'.format(maxThreads))
+
+    with ThreadPoolExecutor(max_workers=maxThreads) as pool:
+        while not stopRequested.is_set():
+            now = time.time()
+            events = claimDue(shareRes, now, maxThreads * 4)
+            if events:
+                for ll in pool.map(lambda e: fireEvent(e, shareRes, dimStats, openClickTimeout, trackingDomainsAllowlist), events):
+                    logger.info(ll)
+            else:
+                shareRes.setKey_int('engage_pending', shareRes.r.zcard(shareRes.rkeyPrefix + schedKey))
+                if not args.f:
+                    break
+                wait = nextDue(shareRes, now)
+                stopRequested.wait(1.0 if wait is None else min(1.0, max(0.0, wait)))
+    if dimStats:
+        dimStats.flush(shareRes)
+    logger.info('** Engagement executor stopped')
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# Offline Monte Carlo check of the statistical model in a consume-mail.ini, without deploying it and waiting for
+# SparkPost reports. For each day of the n-week cycle, the model probabilities are set up exactly as consume-mail.py
+# does (model.py), then the processMail decision tree is drawn for many synthetic recipients at once with NumPy:
+#
+#   OOB?  else FBL?  else Open (if Signals digit is active today)?  -> OpenAgain?  Click? -> ClickAgain?
+#
+# Reported rates are percentages of all traffic to the statistical ("mixed") domain, including the Upstream_Handled
+# share that goes to the PMTA blackhole, which in-band bounces Weekly_Cycle_Bounce_Rate percent of what it receives.
+# Days where a value had to be clipped into 0..1 by probClip are flagged, as the configured rates can't be met there.
+#
+# Pre-requisites:
+#   pip3 install numpy
+#
+import sys, argparse, logging
+from datetime import datetime, timedelta
+from common import readConfig
+from bouncerate import nWeeklyCycle
+from model import getBounceProbabilities, getSignalsOpenDays
+
+actions = ['OOB', 'FBL', 'Open', 'OpenAgain', 'Click', 'ClickAgain']
+chunkSize = 1000000                                         # recipients per vectorised draw, bounds memory use
+
+
+# Draw the decision tree for n recipients on day-of-month dom. Returns dict of action -> count
+def simulateDay(np, rng, P, n, dom, signalsOpenDays, signalsFraction):
+    counts = dict.fromkeys(actions, 0)
+    if signalsOpenDays:
+        openToday = np.array([dom in days for days in signalsOpenDays])
+    for i in range(0, n, chunkSize):
+        m = min(chunkSize, n - i)
+        u = rng.random((6, m))
+        oob = u[0] <= P['OOB']
+        fbl = ~oob & (u[1] <= P['FBL'])
+        doIt = np.ones(m, dtype=bool)
+        if signalsOpenDays:
+            isSignals = rng.random(m) < signalsFraction
+            doIt = ~isSignals | openToday[rng.integers(0, 10, m)]
+        opened = ~oob & ~fbl & (u[2] <= P['Open']) & doIt
+        click = opened & (u[4] <= P['Click_Given_Open'])
+        for k, v in [('OOB', oob), ('FBL', fbl), ('Open', opened), ('OpenAgain', opened & (u[3] <= P['OpenAgain_Given_Open'])),
+                ('Click', click), ('ClickAgain', click & (u[5] <= P['ClickAgain_Given_Click']))]:
+            counts[k] += int(np.count_nonzero(v))
+    return counts
+
+def simulate(cfg, start, days, n, signalsFraction, seed, logger):
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    upstream = cfg.getfloat('Upstream_Handled') / 100
+    bounceCycle = [float(i) for i in cfg.get('Weekly_Cycle_Bounce_Rate', '0').split(',')]
+    _, signalsOpenDays, activeDigitDensity = getSignalsOpenDays(cfg)
+    rows = []
+    for d in range(days):
+        t = start + timedelta(days=d)
+        clipped = []
+        P = getBounceProbabilities(cfg, activeDigitDensity, logger, t=t, clipped=clipped)
+        bounceRate, idx = nWeeklyCycle(bounceCycle, t)
+        row = {'date': t.strftime('%Y-%m-%d %a'), 'cycleDay': idx, 'InBand': upstream * bounceRate, 'clipped': clipped}
+        if P is None:
+            row['invalid'] = True
+        else:
+            counts = simulateDay(np, rng, P, n, t.day, signalsOpenDays, signalsFraction)
+            for k, c in counts.items():
+                row[k] = 100 * (1 - upstream) * c / n            # as % of all traffic to the domain
+        rows.append(row)
+    return rows
+
+def report(rows, cfg):
+    cols = ['InBand'] + actions
+    print('{:16} {:>5} '.format('date', 'cycle') + ' '.join('{:>10}'.format(c) for c in cols) + '  flags')
+    for r in rows:
+        vals = ' '.join('{:10.3f}'.format(r[c]) if c in r else '{:>10}'.format('-') for c in cols)
+        flags = ('!Invalid config ' if r.get('invalid') else '') + ('!Clipped ' + ','.join(r['clipped']) if r['clipped'] else '')
+        print('{:16} {:5d} {}  {}'.format(r['date'], r['cycleDay'], vals, flags))
+    valid = [r for r in rows if not r.get('invalid')]
+    if valid:
+        print('{:22} '.format('mean') + ' '.join('{:10.3f}'.format(sum(r[c] for r in valid) / len(valid)) for c in cols))
+    print('{:22} {:>10} '.format('configured', '') + ' '.join('{:10.3f}'.format(cfg.getfloat(k + '_percent'))
+        for k in ['OOB', 'FBL', 'Open', 'Open_Again', 'Click', 'Click_Again']))
+
+
+# -----------------------------------------------------------------------------
+# Main code
+# -----------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulate the daily OOB, FBL, open, click and in-band bounce rates given by a consume-mail config, over its n-week cycle.')
+    parser.add_argument('-c', '--config', type=str, default='consume-mail.ini', help='config file (default: %(default)s)')
+    parser.add_argument('-n', '--recipients', type=int, default=1000000, help='synthetic recipients per day (default: %(default)s)')
+    parser.add_argument('--start', type=str, help='first day, YYYY-MM-DD (default: today)')
+    parser.add_argument('--days', type=int, help='number of days (default: the length of the Weekly_Cycle_ settings)')
+    parser.add_argument('--signals-fraction', type=float, default=1.0, help='fraction of recipients with the Signals_Traffic_Prefix localpart (default: %(default)s)')
+    parser.add_argument('--seed', type=int, help='random seed, for repeatable results')
+    args = parser.parse_args()
+
+    logger = logging.getLogger('simulate')
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    cfg = readConfig(args.config)
+    start = datetime.strptime(args.start, '%Y-%m-%d') if args.start else datetime.utcnow()
+    start = start.replace(hour=12, minute=0, second=0, microsecond=0)
+    days = args.days or max(len(cfg.get(k, '0').split(',')) for k in ['Weekly_Cycle_Bounce_Rate', 'Weekly_Cycle_Open_Rate'])
+    rows = simulate(cfg, start, days, args.recipients, args.signals_fraction, args.seed, logger)
+    report(rows, cfg)
+    if any(r.get('invalid') for r in rows):
+        sys.exit(1)
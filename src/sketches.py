@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+#
+# Bounded-memory per-dimension statistics held in Redis, e.g. which sending domain is generating FBLs or OOBs.
+#
+# Each dimension (such as 'sending_domain') has a fixed size
+#   - count-min sketch, holding estimated counts of (key, action) pairs, as a Redis hash of depth x width cells
+#   - top-K sorted set of the heaviest keys, scored by their count-min estimate
+#   - HyperLogLog of unique recipients, kept only for keys currently in the top-K
+# so Redis memory is fixed by the config, however many distinct keys the traffic contains.
+#
+# Updates are aggregated in memory and written in pipelined batches.
+#
+import hashlib, threading
+from tracer import span
+from collections import Counter
+
+totalAction = '*'                                               # pseudo-action counting all messages for a key
+
+
+# Cell indices for an item, one per sketch row, by double hashing. Uses a stable hash, as Python's own hash() is
+# randomised per process and the sketch is shared between processes via Redis.
+def cmsCells(item, width, depth):
+    h = hashlib.md5(item.encode('utf-8')).digest()
+    h1 = int.from_bytes(h[:8], 'little')
+    h2 = int.from_bytes(h[8:], 'little') | 1
+    return ['{}:{}'.format(i, (h1 + i * h2) % width) for i in range(depth)]
+
+
+def cmsItem(key, action):
+    return key + '|' + action
+
+
+class DimensionStats():
+    def __init__(self, width=1024, depth=4, topK=100, batchSize=500, hllTtl=10*24*60*60):
+        self.width = width
+        self.depth = depth
+        self.topK = topK
+        self.batchSize = batchSize
+        self.hllTtl = hllTtl
+        self.lock = threading.Lock()
+        self._newBatch()
+
+    def _newBatch(self):
+        self.counts = Counter()                                 # (dim, key, action) -> n
+        self.recipients = {}                                    # (dim, key) -> set of recipient addresses
+        self.pending = 0
+
+    # Record an action against a key in a dimension. Thread-safe. Whichever thread fills the batch writes it to Redis
+    def record(self, shareRes, dim, key, action, recipient=None):
+        if not key:
+            return
+        key = key.lower()
+        with self.lock:
+            self.counts[(dim, key, action)] += 1
+            if recipient:
+                self.recipients.setdefault((dim, key), set()).add(recipient.lower())
+            self.pending += 1
+            full = self.pending >= self.batchSize
+            if full:
+                counts, recipients = self.counts, self.recipients
+                self._newBatch()
+        if full:
+            with span('redis', 'sketch_batch'):
+                self._write(shareRes, counts, recipients)
+
+    # Write out whatever is pending, e.g. at the end of a run
+    def flush(self, shareRes):
+        with self.lock:
+            counts, recipients = self.counts, self.recipients
+            self._newBatch()
+        if counts:
+            self._write(shareRes, counts, recipients)
+
+    def _write(self, shareRes, counts, recipients):
+        r, pfx = shareRes.r, shareRes.rkeyPrefix
+        pipe = r.pipeline(transaction=False)
+        for dim in {c[0] for c in counts}:
+            pipe.set(pfx + 'cmsshape_' + dim, '{}:{}'.format(self.width, self.depth))
+        for (dim, key, action), n in counts.items():
+            for cell in cmsCells(cmsItem(key, action), self.width, self.depth):
+                pipe.hincrby(pfx + 'cms_' + dim, cell, n)
+            pipe.sadd(pfx + 'cmsactions_' + dim, action)        # small fixed vocabulary, used for reporting
+        pipe.execute()
+
+        # Re-score touched keys in the top-K from their (now updated) estimates, then trim back to K
+        touched = sorted({(dim, key) for dim, key, action in counts if action == totalAction})
+        if not touched:
+            return
+        for dim, key in touched:
+            pipe.hmget(pfx + 'cms_' + dim, cmsCells(cmsItem(key, totalAction), self.width, self.depth))
+        est = pipe.execute()
+        for (dim, key), cells in zip(touched, est):
+            pipe.zadd(pfx + 'topk_' + dim, {key: min(int(c or 0) for c in cells)})
+        dims = sorted({dim for dim, _ in touched})
+        for dim in dims:
+            pipe.zrange(pfx + 'topk_' + dim, 0, -(self.topK + 1))
+            pipe.zremrangebyrank(pfx + 'topk_' + dim, 0, -(self.topK + 1))
+        evicted = pipe.execute()[len(touched):][::2]
+
+        # Unique recipients are counted only for keys in the top-K, and dropped for keys that fall out of it
+        for dim, ev in zip(dims, evicted):
+            for key in ev:
+                pipe.delete(pfx + 'hll_' + dim + ':' + key.decode('utf-8'))
+        hllKeys = sorted(recipients)
+        for dim, key in hllKeys:
+            pipe.zscore(pfx + 'topk_' + dim, key)
+        inTopK = pipe.execute()[-len(hllKeys):] if hllKeys else []
+        for (dim, key), score in zip(hllKeys, inTopK):
+            if score is not None:
+                hllKey = pfx + 'hll_' + dim + ':' + key
+                pipe.pfadd(hllKey, *recipients[(dim, key)])
+                pipe.expire(hllKey, self.hllTtl)            # unique recipient counts expire if a key goes quiet
+        pipe.execute()
+
+
+# Read back the top-K keys of each dimension with their estimated per-action counts and unique recipients
+def getDimensionResults(shareRes):
+    r, pfx = shareRes.r, shareRes.rkeyPrefix
+    res = {}
+    topk_pfx = pfx + 'topk_'
+    for k in r.scan_iter(match=topk_pfx + '*'):
+        dim = k.decode('utf-8')[len(topk_pfx):]
+        shape = r.get(pfx + 'cmsshape_' + dim)
+        if not shape:
+            continue
+        width, depth = [int(i) for i in shape.decode('utf-8').split(':')]
+        actions = sorted(a.decode('utf-8') for a in r.smembers(pfx + 'cmsactions_' + dim))
+        keys = [key.decode('utf-8') for key, _ in r.zrevrange(k, 0, -1, withscores=True)]
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            for a in actions:
+                pipe.hmget(pfx + 'cms_' + dim, cmsCells(cmsItem(key, a), width, depth))
+            pipe.pfcount(pfx + 'hll_' + dim + ':' + key)
+        est = iter(pipe.execute())
+        rows = []
+        for key in keys:
+            row = {'key': key}
+            for a in actions:
+                n = min(int(c or 0) for c in next(est))
+                if n:
+                    row['messages' if a == totalAction else a] = n
+            row['unique_recipients'] = next(est)
+            rows.append(row)
+        res[dim] = rows
+    return res
+
+
+# Per-message wrapper for the shared results handle. Every counter incremented while handling a message is also
+# attributed to that message's dimension keys, e.g. fbl_sent against its sending domain.
+class MessageStats():
+    def __init__(self, shareRes, dimStats, dims, recipient=None):
+        self.shareRes = shareRes
+        self.dimStats = dimStats
+        self.dims = dims                                        # list of (dimension, key) pairs
+        if dimStats:
+            for dim, key in dims:
+                dimStats.record(shareRes, dim, key, totalAction, recipient)
+
+    def incrementKey(self, k):
+        self.shareRes.incrementKey(k)
+        if self.dimStats:
+            for dim, key in self.dims:
+                self.dimStats.record(self.shareRes, dim, key, k)
+
+    # Record an action against some other dimension, e.g. the tracking host of a link
+    def recordDimension(self, dim, key, action):
+        if self.dimStats:
+            self.dimStats.record(self.shareRes, dim, key, totalAction)
+            self.dimStats.record(self.shareRes, dim, key, action)
+
+    def __getattr__(self, name):
+        return getattr(self.shareRes, name)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# Per-message timeline tracer, for finding which message and which step is slow.
+#
+# Each worker thread's message has a timeline of spans (parse, decide, DNS, SMTP, http and Redis calls, with host).
+# Timelines are kept for a sampled fraction of messages, and always for messages slower than a threshold, in a capped
+# Redis stream that webReporter lists at /traces.
+#
+# Code on the message path marks steps with
+#   with span('smtp', mx):
+#       ...
+# which costs next to nothing for threads that aren't tracing.
+#
+import time, json, random, threading
+
+local = threading.local()
+tracesKey = 'traces'
+
+
+class Trace():
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.t0 = time.perf_counter()
+        self.spans = []
+        self.current = None                                     # (step, host, t) of the span in progress, if any
+
+    def elapsed(self):
+        return time.perf_counter() - self.t0
+
+
+class Span():
+    def __init__(self, trace, step, host):
+        self.trace, self.step, self.host = trace, step, host
+
+    def __enter__(self):
+        self.t = time.perf_counter()
+        self.outer = self.trace.current
+        self.trace.current = (self.step, self.host, self.t)
+        return self
+
+    def __exit__(self, *exc):
+        tr = self.trace
+        tr.spans.append({'step': self.step, 'host': self.host, 'at_ms': round((self.t - tr.t0) * 1000, 1),
+            'ms': round((time.perf_counter() - self.t) * 1000, 1), 'error': exc[0].__name__ if exc[0] else None})
+        tr.current = self.outer
+        return False
+
+
+class NoSpan():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+noSpan = NoSpan()
+
+# Mark a step on this thread's message timeline, if it has one
+def span(step, host=''):
+    tr = getattr(local, 'trace', None)
+    return Span(tr, step, host) if tr else noSpan
+
+
+class Tracer():
+    def __init__(self, sampleRate, slowThreshold, maxTraces):
+        self.sampleRate = sampleRate                            # fraction of messages kept regardless of latency
+        self.slowThreshold = slowThreshold                      # seconds; slower messages are always kept
+        self.maxTraces = maxTraces                              # approximate cap on the Redis stream length
+        self.lock = threading.Lock()
+        self.active = {}                                        # thread ident -> Trace in progress
+
+    def begin(self, name):
+        tr = Trace(name)
+        local.trace = tr
+        with self.lock:
+            self.active[threading.get_ident()] = tr
+
+    # Finish this thread's timeline, keeping it if sampled or slow. Returns elapsed time (s)
+    def end(self, shareRes):
+        tr = getattr(local, 'trace', None)
+        local.trace = None                                      # so writing the trace isn't itself traced
+        with self.lock:
+            self.active.pop(threading.get_ident(), None)
+        if not tr:
+            return 0.0
+        el = tr.elapsed()
+        if el >= self.slowThreshold or random.random() < self.sampleRate:
+            try:
+                shareRes.r.xadd(shareRes.rkeyPrefix + tracesKey, {'msg': tr.name, 'start': tr.start, 'ms': round(el * 1000, 1),
+                    'slow': int(el >= self.slowThreshold), 'spans': json.dumps(tr.spans)}, maxlen=self.maxTraces, approximate=True)
+            except Exception:
+                pass                                            # tracing must never break message handling
+        return el
+
+    # What a (possibly hung) thread is doing right now, for the gather timeout message
+    def describe(self, thread):
+        with self.lock:
+            tr = self.active.get(thread.ident)
+        if not tr:
+            return ''
+        s = '{},running {:.1f}s'.format(tr.name, tr.elapsed())
+        if tr.current:
+            step, host, t = tr.current
+            s += ',in {} {} for {:.1f}s'.format(step, host, time.perf_counter() - t)
+        return s
+
+
+# Slowest recent traces, for reporting
+def getSlowTraces(shareRes, n=50, scan=1000):
+    res = []
+    for _, f in shareRes.r.xrevrange(shareRes.rkeyPrefix + tracesKey, count=scan):
+        f = {k.decode('utf-8'): v.decode('utf-8') for k, v in f.items()}
+        res.append({'msg': f['msg'], 'start': float(f['start']), 'ms': float(f['ms']), 'slow': f['slow'] == '1',
+            'spans': json.loads(f['spans'])})
+    res.sort(key=lambda t: t['ms'], reverse=True)
+    return res[:n]
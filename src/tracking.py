@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+#
+# Access to SparkPost engagement tracking endpoints, shared by the consumer (inline opens & clicks) and the deferred
+# engagement executor in scheduler.py
+#
+from urllib.parse import urlparse
+from tracer import span
+from budget import noBudget
+
+# Heuristic for whether this is really SparkPost: identifies itself in Server header
+# if domain in allowlist, then skip the checks
+def isSparkPostTrackingEndpoint(s, url, shareRes, openClickTimeout, trackingDomainsAllowlist, budget=noBudget):
+    err = None
+    scheme, netloc, _, _, _, _ = urlparse(url)
+    if netloc in trackingDomainsAllowlist:
+        return True, err
+    baseurl = scheme + '://' + netloc
+    # optimisation - check if we already know this is SparkPost or not
+    known = shareRes.getKey(baseurl)
+    if known:
+        known_bool = (known == b'1')
+        if not known_bool:
+            err = '!Tracking domain ' + baseurl + ' blocked'
+        return known_bool, err                                # response is Bytestr, compare back to a Boolean
+    else:
+        # Ping the path prefix for clicks
+        with span('http_check', netloc):
+            r = s.get(baseurl + '/f/a', allow_redirects=False, timeout=budget.timeout(openClickTimeout))
+        isSparky = r.headers.get('Server') == 'msys-http'
+        if not isSparky:
+            err = url + ',status_code ' + str(r.status_code)
+        # NOTE redis-py now needs data passed in bytestr
+        isB = str(int(isSparky)).encode('utf-8')
+        _ = shareRes.setKey(baseurl, isB, ex=3600)         # mark this as known, but with an expiry time
+        return isSparky, err
+
+# Improved "GET" - doesn't follow the redirect, and opens as stream (so doesn't actually fetch a lot of stuff)
+def touchEndPoint(s, url, openClickTimeout, userAgent, budget=noBudget):
+    with span('http', urlparse(url).netloc):
+        _ = s.get(url, allow_redirects=False, timeout=budget.timeout(openClickTimeout), stream=True, headers={'User-Agent': userAgent})
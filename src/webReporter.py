@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 #
-# Web reporting and access functions for shared data held in Redis
+# Web reporting for shared data held in Redis. Access to the data itself is in results.py
 # Expects to be run in main project directory, i.e, resources in relative path ./templates
 #
 # Author: Steve Tuck.  (c) 2018 SparkPost
@@ -8,94 +8,91 @@
 # Pre-requisites:
 #   pip3 install flask, redis, flask-cors
 #
-import os, redis, json
-from flask import Flask, make_response, render_template, request, send_file
-from datetime import datetime, timezone
+import os, json, time, math, hmac, queue, threading
+from flask import Flask, Response, make_response, render_template, request, send_file
 from flask_cors import CORS, cross_origin
+from results import Results, timeStr, getClusterResults, getClusterArrayResults
+from sketches import getDimensionResults
+from tracer import getSlowTraces
+from profiler import requestProfile, getLastProfile
 app = Flask(__name__)
 cors = CORS(app)
 app.config['CORS_HEADERS'] = 'Content-Type'
 
-def timeStr(t):
-    utc = datetime.fromtimestamp(t, timezone.utc)
-    return datetime.isoformat(utc, sep='T', timespec='seconds')
-
-class Results():
-    def __init__(self):
-        # Set up a persistent connection to redis results
-        appName = 'consume-mail'
-        redisUrl = os.getenv('REDIS_URL', default='redis://localhost')      # Env var is set by Heroku; will be unset when local
-        self.r = redis.from_url(redisUrl, socket_timeout=5)                 # shorten timeout so doesn't hang forever
-        self.rkeyPrefix = appName + ':' + os.getenv('RESULTS_KEY', default='0') + ':'    # allows unique app instances if needed (e.g. Heroku)
-
-    # Access to Redis data
-    def getKey(self, k):
-        res = self.r.get(self.rkeyPrefix + k)
-        return res
-
-    # returns True if data written back to Redis OK. v is a value to write, optional keyword args are passed on down
-    def setKey(self, k, v, **kwargs):
-        ok = self.r.set(self.rkeyPrefix + k, v, **kwargs)
-        return ok
-
-    # collect basic metrics, i.e. started_running, and any keys prefixed int_.  Provide default value for startedRunning
-    def getMatchingResults(self):
-        stR = self.getKey('startedRunning')
-        if stR:
-            res = {'startedRunning': stR.decode('utf-8') }
-        else:
-            res = {'startedRunning': 'Not yet - waiting for scheduled running to begin'}  # default data
-        int_pfx = self.rkeyPrefix + 'int_'
-        for k in self.r.scan_iter(match=int_pfx+'*'):
-            v = self.r.get(k).decode('utf-8')
-            idx = k.decode('utf-8') [len(int_pfx):]                     # strip the app prefix
-            res[idx] =  int(v)                                      # use as int
-        return res
-
-    # wrapper functions for integer type counters. Mark type in key name, as all redis objs are natively Bytes
-    def incrementKey(self, k):
-        self.r.incr(self.rkeyPrefix + 'int_' + k)
-
-    def decrementKey(self, k):
-        self.r.decr(self.rkeyPrefix + 'int_' + k)
-
-    def getKey_int(self, k):
-        v = self.r.get(self.rkeyPrefix + 'int_' + k)                    # force conversion on way out
-        if v:
-            v2 = v.decode('utf-8')
-            return int(v2) if v2.isnumeric() else 0
-        else:
-            return 0
-
-    def setKey_int(self, k, v):
-        ok = self.r.set(self.rkeyPrefix + 'int_' + k, v)                # allow redis to set type on way in
-        return ok
-
-    def incrementTimeSeries(self, k):
-        self.r.incr(self.rkeyPrefix + 'ts_' + k)
-
-    def delTimeSeriesOlderThan(self, t):
-        for i in ['ts_*', 'ps_*']:
-            for k in self.r.scan_iter(match=self.rkeyPrefix + i):
-                idx = k.decode('utf-8') [len(self.rkeyPrefix):]         # strip the app prefix
-                ts = int(idx[len('ts_'):])                              # got the metric's timestamp as int
-                if ts < t:
-                    self.r.delete(k)
-
-    def getArrayResults(self, pfx, keyName):
-        ts_pfx = self.rkeyPrefix + pfx
-        t = {}
-        for k in self.r.scan_iter(match=ts_pfx+'*'):
-            v = self.r.get(k).decode('utf-8')
-            idx = k.decode('utf-8') [len(ts_pfx):]                      # strip the app prefix
-            unixTime = (int(idx) // 60) * 60                            # round it to per-minute resolution (so we get matches) - may be lossy
-            ascTime = timeStr(unixTime)
-            t[ascTime] = int(v)                                         # build dict of (time / value) pairs
-        res = []
-        for t, v in sorted(t.items()):
-            res.append( {'time' : t, keyName: v } )
-        return res
-
+# Live counter updates for any number of browsers, from a single background poller. The poller reads Redis once per
+# interval while anyone is connected, and pushes only the counters that changed to each client's queue, so Redis load
+# from the dashboard stays flat however many are open. Stops when the last client goes.
+class CounterStream():
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.latest = {}                                            # full counters, sent to each new client first
+        self.latestTs = None
+        self.poller = None
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=100)
+        with self.lock:
+            self.clients.add(q)
+            if not self.poller:
+                self.poller = threading.Thread(target=self.run, daemon=True)
+                self.poller.start()
+            return q, dict(self.latest)
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.clients.discard(q)
+
+    def isSubscribed(self, q):
+        with self.lock:
+            return q in self.clients
+
+    def run(self):
+        shareRes = Results()
+        while True:
+            with self.lock:
+                if not self.clients:
+                    self.poller = None
+                    self.latest = {}
+                    return
+            try:
+                r = shareRes.getMatchingResults()
+                delta = {k: v for k, v in r.items() if self.latest.get(k) != v}
+                ts = shareRes.getRecentTimeSeries(time.time(), 2, 'messages')     # previous minute is now final
+                if ts != self.latestTs:
+                    delta['ts'] = ts
+                with self.lock:
+                    self.latest, self.latestTs = r, ts
+                    for q in list(self.clients if delta else []):
+                        try:
+                            q.put_nowait(delta)
+                        except queue.Full:
+                            self.clients.discard(q)                 # client isn't reading, drop it
+            except Exception:
+                app.logger.exception('Counter stream poll failed')  # Redis hiccup - keep polling
+            time.sleep(self.interval)
+
+counterStream = CounterStream(float(os.getenv('STREAM_INTERVAL', default='2')))
+
+# Fleet-wide views read every instance's keys, so keep them for a short while rather than rebuilding on every request
+clusterCacheSeconds = float(os.getenv('CLUSTER_CACHE_SECONDS', default='5'))
+clusterCache = {}
+clusterCacheLock = threading.Lock()
+
+def cachedCluster(name, fn):
+    now = time.time()
+    with clusterCacheLock:
+        hit = clusterCache.get(name)
+        if hit and hit[0] > now:
+            return hit[1]
+    v = fn()
+    with clusterCacheLock:
+        clusterCache[name] = (now + clusterCacheSeconds, v)
+    return v
+
+def wantCluster():
+    return request.args.get('cluster', '').lower() in ('1', 'true', 'yes')
 
 # Flask entry points
 @app.route('/', methods=['GET'])
@@ -106,11 +103,15 @@ def status_html():
     res = render_template('index.html', **r, thisUrl=request.url)
     return res
 
-# This entry point returns JSON-format summary results report
+# This entry point returns JSON-format summary results report. With ?cluster=1, merged totals across all sink instances
+# sharing this Redis, plus per-instance breakdowns
 @app.route('/json', methods=['GET'])
 def status_json():
     shareRes = Results()                                            # class for sharing summary results
-    r = shareRes.getMatchingResults()
+    if wantCluster():
+        r = cachedCluster('json', lambda: getClusterResults(shareRes))
+    else:
+        r = shareRes.getMatchingResults()
     flaskRes = make_response(json.dumps(r))
     flaskRes.headers['Content-Type'] = 'application/json'
     return flaskRes
@@ -120,11 +121,89 @@ def status_json():
 @cross_origin()
 def json_ts_messages():
     shareRes = Results()
-    m = shareRes.getArrayResults('ts_', 'messages')
+    if wantCluster():
+        m = cachedCluster('ts-messages', lambda: getClusterArrayResults(shareRes, 'ts_', 'messages'))
+    else:
+        m = shareRes.getArrayResults('ts_', 'messages')
     flaskRes = make_response(json.dumps(m))
     flaskRes.headers['Content-Type'] = 'application/json'
     return flaskRes
 
+# Heaviest sending domains, subdomains and tracking hosts, with estimated per-action counts and unique recipients
+@app.route('/json/dimensions', methods=['GET'])
+@cross_origin()
+def json_dimensions():
+    shareRes = Results()
+    d = getDimensionResults(shareRes)
+    flaskRes = make_response(json.dumps(d))
+    flaskRes.headers['Content-Type'] = 'application/json'
+    return flaskRes
+
+# Slowest recent per-message timelines recorded by the consumer's tracer
+@app.route('/traces', methods=['GET'])
+def traces_html():
+    shareRes = Results()
+    t = getSlowTraces(shareRes)
+    for i in t:
+        i['startStr'] = timeStr(i['start'])
+    return render_template('traces.html', traces=t, thisUrl=request.url)
+
+@app.route('/json/traces', methods=['GET'])
+@cross_origin()
+def json_traces():
+    shareRes = Results()
+    t = getSlowTraces(shareRes)
+    flaskRes = make_response(json.dumps(t))
+    flaskRes.headers['Content-Type'] = 'application/json'
+    return flaskRes
+
+# Server-Sent Events stream of counter changes. First event is the full set of counters, then only what changed
+@app.route('/stream', methods=['GET'])
+@cross_origin()
+def stream():
+    q, latest = counterStream.subscribe()
+    def events():
+        try:
+            if latest:
+                yield 'data: {}\n\n'.format(json.dumps(latest))
+            while True:
+                try:
+                    yield 'data: {}\n\n'.format(json.dumps(q.get(timeout=15)))
+                except queue.Empty:
+                    if not counterStream.isSubscribed(q):
+                        return                                  # dropped for falling behind; browser reconnects and resyncs
+                    yield ': keepalive\n\n'                    # comment line, keeps proxies from timing out the connection
+        finally:
+            counterStream.unsubscribe(q)
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Ask the consumer to take a sampling profile (POST, with optional seconds), or get the last one's top functions (GET).
+# Only enabled if the ADMIN_TOKEN env var is set, and the same token is given in the X-Admin-Token header, or in the
+# POST body. Not in the query string, so it doesn't end up in access logs and browser history
+maxProfileSeconds = 300
+
+@app.route('/admin/profile', methods=['GET', 'POST'])
+def admin_profile():
+    adminToken = os.getenv('ADMIN_TOKEN')
+    token = request.headers.get('X-Admin-Token') or request.form.get('token')
+    if not adminToken or not token or not hmac.compare_digest(token, adminToken):
+        return make_response('Forbidden', 403)
+    shareRes = Results()
+    if request.method == 'POST':
+        try:
+            seconds = float(request.values.get('seconds', 30))
+        except ValueError:
+            return make_response('seconds must be a number', 400)
+        if not 0 < seconds < math.inf:
+            return make_response('seconds must be positive', 400)
+        seconds = min(seconds, maxProfileSeconds)
+        r = {'requested': bool(requestProfile(shareRes, seconds)), 'seconds': seconds}
+    else:
+        r = getLastProfile(shareRes) or {}
+    flaskRes = make_response(json.dumps(r))
+    flaskRes.headers['Content-Type'] = 'application/json'
+    return flaskRes
+
 @app.route('/favicon.ico')
 def favicon():
     return send_file('favicon.ico', mimetype='image/vnd.microsoft.icon')